@@ -0,0 +1,145 @@
+import asyncio
+import contextlib
+import json
+import sys
+import time
+import feishu
+import metrics
+import throttle
+
+# asyncio counterpart of feishu.py for --engine async, needs aiohttp
+# one ClientSession with one connection pool is shared by all coroutines of
+# a run; throttles, retry policies and metrics are the same as in feishu.py
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+def parse(body):
+    return json.loads(body)
+
+
+async def auth_headers(access_token):
+    # the refresh of auth.UserToken is a blocking request, done in a thread
+    if callable(access_token) and not access_token.fresh():
+        await asyncio.to_thread(access_token)
+    return feishu.auth_headers(access_token)
+
+
+def rate_limited(resp, body):
+    if resp.status == 429:
+        return True
+    if resp.content_type == "application/json" and body is not None:
+        try:
+            return parse(body).get("code") in throttle.rate_limit_codes
+        except ValueError:
+            return False
+    return False
+
+
+class Client:
+    def __init__(self) -> None:
+        if aiohttp is None:
+            raise SystemExit("--engine async needs the aiohttp package")
+        connect, read = feishu.timeout
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=feishu.pool_size),
+            timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read),
+        )
+
+    async def close(self):
+        await self.session.close()
+
+    async def request(
+        self, method, url, access_token, headers=None, stream=False, **kwargs
+    ):
+        # returns the response and its body, the body is None for stream=True
+        # and the caller has to release the response
+        t = throttle.throttle(url)
+        retry = feishu.retry_policy(url)
+        errors = 0
+        for attempt in range(feishu.max_attempts):
+            await asyncio.sleep(t.reserve())
+            # built for every attempt, the backoff can outlast the access token
+            attempt_headers = {**await auth_headers(access_token), **(headers or {})}
+            start = time.monotonic()
+            try:
+                resp = await self.session.request(
+                    method, feishu.resolve(url), headers=attempt_headers, **kwargs
+                )
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                # like urllib3, connection errors count against the retry total
+                if errors >= retry.total:
+                    raise
+                errors += 1
+                await asyncio.sleep(retry.backoff_factor * 2 ** (errors - 1))
+                continue
+
+            if errors < retry.total and retry.is_retry(method, resp.status):
+                resp.release()
+                errors += 1
+                await asyncio.sleep(retry.backoff_factor * 2 ** (errors - 1))
+                continue
+
+            body = None
+            if not stream or resp.content_type == "application/json":
+                body = await resp.read()
+            elapsed = time.monotonic() - start
+            size = None if body is None else len(body)
+            if not rate_limited(resp, body):
+                metrics.request(t.name, resp.status, elapsed, size)
+                t.success()
+                return resp, body
+
+            metrics.request(t.name, "rate_limited", elapsed, size)
+            wait = throttle.backoff(attempt, throttle.retry_after(resp))
+            print(f"Rate limited on {t.name}, retrying in {wait:.1f}s")
+            resp.release()
+            t.rate_limited(wait)
+
+        print(
+            f"Request to {url} is still rate limited after {feishu.max_attempts} attempts"
+        )
+        sys.exit(1)
+
+    async def get(self, url, access_token):
+        _, body = await self.request("GET", url, access_token)
+        data = parse(body)
+        if data["code"] != 0:
+            print(f"Request to {url} failed with: {data}")
+            sys.exit(1)
+        return data["data"]
+
+    async def pages(self, url, access_token, token_field="page_token"):
+        # like feishu.pages, the next page is fetched while the caller
+        # handles the current one
+        sep = "&" if "?" in url else "?"
+        task = asyncio.create_task(self.get(url, access_token))
+        try:
+            while task is not None:
+                data = await task
+                if data.get("has_more"):
+                    next_url = f"{url}{sep}page_token={data[token_field]}"
+                    task = asyncio.create_task(self.get(next_url, access_token))
+                else:
+                    task = None
+                yield data
+        finally:
+            if task is not None:
+                task.cancel()
+
+    async def post(self, url, access_token=None, json=None):
+        _, body = await self.request("POST", url, access_token, json=json)
+        return parse(body)
+
+    @contextlib.asynccontextmanager
+    async def download(self, url, access_token, headers=None):
+        resp, _ = await self.request(
+            "GET", url, access_token, headers=headers, stream=True
+        )
+        try:
+            yield resp
+        finally:
+            resp.release()
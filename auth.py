@@ -0,0 +1,166 @@
+import contextlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import feishu
+
+try:
+    import fcntl
+except ImportError:
+    # windows: no lock between processes
+    fcntl = None
+
+# user access token of the oauth login, cached on disk so later runs can start
+# without the browser callback, and refreshed before it expires
+# https://open.feishu.cn/document/server-docs/authentication-management/access-token/create-2
+# https://open.feishu.cn/document/server-docs/authentication-management/access-token/refresh-user-access-token
+
+# refresh when the access token expires within this many seconds
+refresh_margin = 300
+
+# logins are kept out of backup_path, which is copied to other machines;
+# next to secret.py by default, see --state-path
+state_path = os.path.dirname(os.path.abspath(__file__))
+
+
+def token_path(account=None):
+    # the login shared by backup.py and backup-calendar.py, or the login of
+    # an account in batch mode
+    if account is None:
+        return f"{state_path}/.user_token.json"
+    return f"{state_path}/.user_tokens/{account}.json"
+
+
+def move_token(old_path, new_path):
+    # logins cached in backup_path by earlier versions
+    if os.path.exists(old_path) and not os.path.exists(new_path):
+        print(f"Moving cached login {old_path} to {new_path}")
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        shutil.move(old_path, new_path)
+
+
+def app_tokens(app_id, app_secret):
+    # app_access_token and tenant_access_token, valid for two hours
+    # https://open.feishu.cn/document/server-docs/authentication-management/access-token/app_access_token_internal
+    resp = feishu.post(
+        "https://open.feishu.cn/open-apis/auth/v3/app_access_token/internal",
+        json={"app_id": app_id, "app_secret": app_secret},
+    )
+    if resp.get("code") != 0:
+        print(f"Failed to get app access token: {resp}")
+        sys.exit(1)
+    return resp
+
+
+class UserToken:
+    # call the object to get a valid access token
+    def __init__(self, file_path, app_id, app_secret) -> None:
+        self.file_path = file_path
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.lock = threading.Lock()
+        # {"access_token", "expires_at", "refresh_token", "refresh_expires_at",
+        #  "open_id", "name"}
+        self.data = self.load()
+
+    def load(self):
+        if self.file_path is not None and os.path.exists(self.file_path):
+            with open(self.file_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return None
+
+    def valid(self) -> bool:
+        # a cached login that can still be refreshed
+        with self.lock:
+            return (
+                self.data is not None
+                and self.data["refresh_expires_at"] > time.time() + refresh_margin
+            )
+
+    def login(self, code):
+        with self.lock:
+            self.request(
+                "https://open.feishu.cn/open-apis/authen/v1/access_token",
+                {"grant_type": "authorization_code", "code": code},
+            )
+
+    @contextlib.contextmanager
+    def file_lock(self):
+        # held by one process at a time, e.g. backup.py and backup-calendar.py
+        # started together by cron; a separate file as save replaces the token
+        if self.file_path is None or fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        fd = os.open(f"{self.file_path}.lock", os.O_WRONLY | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def refresh(self):
+        # called with lock held
+        # another process may have refreshed it already, and a refresh token
+        # can only be used once
+        with self.file_lock():
+            data = self.load()
+            if data is not None and data["expires_at"] > self.data["expires_at"]:
+                self.data = data
+                if data["expires_at"] > time.time() + refresh_margin:
+                    return
+            print("Refreshing user access token")
+            self.request(
+                "https://open.feishu.cn/open-apis/authen/v1/refresh_access_token",
+                {
+                    "grant_type": "refresh_token",
+                    "refresh_token": self.data["refresh_token"],
+                },
+            )
+
+    def request(self, url, body):
+        app_access_token = app_tokens(self.app_id, self.app_secret)["app_access_token"]
+        resp = feishu.post(url, app_access_token, json=body)
+        if resp.get("code") != 0:
+            print(f"Failed to get user access token: {resp}")
+            sys.exit(1)
+        data = resp["data"]
+        old = self.data or {}
+        now = time.time()
+        self.data = {
+            "access_token": data["access_token"],
+            "expires_at": now + data["expires_in"],
+            "refresh_token": data["refresh_token"],
+            "refresh_expires_at": now + data["refresh_expires_in"],
+            # the account, used to name the folder in batch mode
+            "open_id": data.get("open_id", old.get("open_id")),
+            "name": data.get("name", old.get("name")),
+        }
+        self.save()
+
+    def save(self):
+        # only readable by the owner, the refresh token is valid for 30 days
+        # file_path is None until a batch login knows the account
+        if self.file_path is None:
+            return
+        tmp_path = f"{self.file_path}.tmp"
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.chmod(tmp_path, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(self.data, f)
+        os.replace(tmp_path, self.file_path)
+
+    def fresh(self) -> bool:
+        # the access token can be used without a refresh
+        with self.lock:
+            return self.data["expires_at"] > time.time() + refresh_margin
+
+    def __call__(self) -> str:
+        with self.lock:
+            if self.data["expires_at"] <= time.time() + refresh_margin:
+                self.refresh()
+            return self.data["access_token"]
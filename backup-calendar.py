@@ -1,10 +1,9 @@
-from threading import Thread
+from threading import Thread, Lock
+import asyncio
 from typing import List
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-import sys
+import functools
 import json
+import sys
 import os
 import argparse
 from datetime import datetime, timezone
@@ -14,21 +13,52 @@ from urllib.parse import quote
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from urllib.parse import urlparse, parse_qs
 from secret import *
+import feishu
+import aiofeishu
+import auth
+from auth import UserToken
+import throttle
+import metrics
+from feishu import get
+from checkpoint import Checkpoint
+from worker import WorkerPool
+from output import open_output, formats, replace_changed
 
 # docs: https://open.feishu.cn/document/server-docs/calendar-v4/overview
 
 app_access_token = ""
 tenant_access_token = ""
 user_access_token = ""
+user_token = None
+headless = False
 filter = None
+full = False
+resume = False
+checkpoint = None
+output_format = "dir"
+output = None
+# calendars fetched concurrently
+jobs = 4
+# one .ics with all events per calendar instead of one per event
+combined = False
+# threads or async, see crawl_async
+engine = "threads"
+sync_tokens_lock = Lock()
+
+# max page size of the event list
+# https://open.feishu.cn/document/server-docs/calendar-v4/calendar-event/list
+page_size = 1000
+
+calendar_header = """BEGIN:VCALENDAR
+PRODID:-//Jiajie Chen///feishu-backup v1.0//EN
+VERSION:2.0
+"""
+calendar_footer = "END:VCALENDAR\n"
 
 
 def init():
     # get app_access_token and tenant_access_token
-    resp = requests.post(
-        "https://open.feishu.cn/open-apis/auth/v3/app_access_token/internal",
-        json={"app_id": app_id, "app_secret": app_secret},
-    ).json()
+    resp = auth.app_tokens(app_id, app_secret)
 
     global app_access_token
     app_access_token = resp["app_access_token"]
@@ -39,135 +69,348 @@ def init():
     print("Tenant Access Token:", tenant_access_token)
     print("App Access Token:", app_access_token)
 
+    # cached login of an earlier run, shared by backup.py and backup-calendar.py
+    global user_token
+    auth.move_token(f"{backup_path}/.user_token.json", auth.token_path())
+    user_token = UserToken(auth.token_path(), app_id, app_secret)
 
-# utility
 
+@functools.lru_cache(maxsize=None)
+def zone(name):
+    return ZoneInfo(name)
 
-def get(url, access_token):
-    # retry logic from https://gist.github.com/benjiao/28dc36bd87121b3273e0b3e079a8e8d8
-    retries = Retry()
-    with requests.Session() as s:
-        s.mount("http://", HTTPAdapter(max_retries=retries))
-        s.mount("https://", HTTPAdapter(max_retries=retries))
 
-        resp = s.get(url, headers={"Authorization": f"Bearer {access_token}"})
-        json = resp.json()
-        if json["code"] != 0:
-            print(f"Request to {url} failed with: {json}")
-            sys.exit(1)
-        return json["data"]
+@functools.lru_cache(maxsize=None)
+def parse_date(date):
+    return datetime.strptime(date, "%Y-%m-%d").strftime("%Y%m%d")
 
 
 def parse_time(data):
     if "timestamp" in data:
         time = datetime.fromtimestamp(
-            int(data["timestamp"]), ZoneInfo(data["timezone"])
+            int(data["timestamp"]), zone(data["timezone"])
         ).strftime("%Y%m%dT%H%M%S")
         return f"TZID={data['timezone']}:{time}"
     else:
-        date = datetime.strptime(data["date"], "%Y-%m-%d").strftime("%Y%m%d")
-        return f"VALUE=DATE:{date}"
+        return f"VALUE=DATE:{parse_date(data['date'])}"
+
+
+def format_event(event):
+    create_time = datetime.fromtimestamp(
+        int(event["create_time"]), timezone.utc
+    ).strftime("%Y%m%dT%H%M%SZ")
+    start_time = parse_time(event["start_time"])
+    end_time = parse_time(event["end_time"])
+
+    if "recurrence" in event and len(event["recurrence"]) > 0:
+        recurrence = f"\nRRULE:{event['recurrence']}"
+    else:
+        recurrence = ""
+
+    if "location" in event and "name" in event["location"]:
+        location = f"\nLOCATION:{event['location']['name']}"
+    else:
+        location = ""
+
+    return f"""BEGIN:VEVENT
+CREATED:{create_time}
+DTSTAMP:{create_time}
+UID:{event['event_id']}{recurrence}{location}
+DTSTART;{start_time}
+DTEND;{end_time}
+SUMMARY:{event['summary']}
+END:VEVENT
+"""
+
+
+def save_event(event):
+    event_id = event["event_id"]
+    # save raw json
+    output.write(f"/calendar/{event_id}.json", json.dumps(event) + "\n")
+
+    # save icalendar
+    output.write(
+        f"/calendar/{event_id}.ics",
+        calendar_header + format_event(event) + calendar_footer,
+    )
+
+
+def events_path(calendar_id):
+    # raw json of all events of a calendar, one per line, for --combined
+    return f"{backup_path}/calendar/{calendar_id}.jsonl"
+
 
+def load_events(calendar_id):
+    events = {}
+    if os.path.exists(events_path(calendar_id)):
+        with open(events_path(calendar_id), "r", encoding="utf-8") as file:
+            for line in file:
+                event = json.loads(line)
+                events[event["event_id"]] = event
+    return events
 
-state = "backup"
-redirect_uri = quote("http://127.0.0.1:8888/backup")
-url = f"https://open.feishu.cn/open-apis/authen/v1/index?redirect_uri={redirect_uri}&app_id={app_id}&state={state}"
-print(f"Please open {url} in browser")
+
+def save_calendar(calendar_id, events):
+    tmp_path = f"{events_path(calendar_id)}.tmp"
+    with open(tmp_path, "w", encoding="utf-8", buffering=1024 * 1024) as file:
+        for event in events.values():
+            file.write(json.dumps(event))
+            file.write("\n")
+    replace_changed(tmp_path, events_path(calendar_id))
+
+    with output.open(f"/calendar/{calendar_id}.ics") as file:
+        file.write(calendar_header)
+        for event in events.values():
+            file.write(format_event(event))
+        file.write(calendar_footer)
+
+
+def remove_event(event_id):
+    for ext in ["json", "ics"]:
+        output.remove(f"/calendar/{event_id}.{ext}")
+
+
+def load_sync_tokens():
+    # calendar_id -> sync_token of the last finished run
+    if os.path.exists(sync_tokens_path()):
+        with open(sync_tokens_path(), "r", encoding="utf-8") as file:
+            return json.load(file)
+    return {}
+
+
+def save_sync_tokens(sync_tokens):
+    tmp_path = f"{sync_tokens_path()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(sync_tokens, file, indent=1)
+    os.replace(tmp_path, sync_tokens_path())
+
+
+def sync_tokens_path():
+    return f"{backup_path}/calendar/sync_tokens.json"
+
+
+def events_url(calendar_id):
+    # https://open.feishu.cn/document/server-docs/calendar-v4/calendar-event/list
+    return (
+        f"https://open.feishu.cn/open-apis/calendar/v4/calendars/{calendar_id}/events"
+    )
+
+
+calendars_url = "https://open.feishu.cn/open-apis/calendar/v4/calendars?page_size=500"
+
+
+def sync_start(calendar_id, sync_token):
+    # without sync_token: list all events from the beginning
+    # with sync_token: only events created, changed or cancelled since then
+    # returns the state of the sync, updated by sync_page
+    progress = checkpoint.calendar(calendar_id)
+    events = None
+    if combined:
+        # the events of earlier pages are only kept in memory,
+        # so an interrupted calendar starts over
+        progress = None
+        if not os.path.exists(events_path(calendar_id)):
+            # no earlier events to apply the changes to
+            sync_token = None
+        events = load_events(calendar_id) if sync_token is not None else {}
+
+    if progress is not None:
+        print("Resuming from checkpoint")
+        params = progress["params"]
+        page_token = progress["page_token"]
+    elif sync_token is not None:
+        print("Fetching changes since last run")
+        params = f"sync_token={sync_token}"
+        page_token = None
+    else:
+        params = "anchor_time=0"
+        page_token = None
+    return {
+        "calendar_id": calendar_id,
+        "params": params,
+        "page_token": page_token,
+        "sync_token": sync_token,
+        "events": events,
+        "done": False,
+    }
+
+
+def sync_url(state):
+    url = f"{events_url(state['calendar_id'])}?page_size={page_size}"
+    if state["page_token"] is not None:
+        url += f"&page_token={state['page_token']}"
+    return f"{url}&{state['params']}"
+
+
+def sync_page(state, data):
+    calendar_id = state["calendar_id"]
+    events = state["events"]
+    items = data.get("items", [])
+    print(f"Found {len(items)} events in {calendar_id}")
+
+    for event in items:
+        if event["status"] != "cancelled":
+            metrics.document("event")
+        if combined:
+            if event["status"] == "cancelled":
+                events.pop(event["event_id"], None)
+            else:
+                events[event["event_id"]] = event
+        elif event["status"] == "cancelled":
+            remove_event(event["event_id"])
+        else:
+            save_event(event)
+
+    if data["has_more"]:
+        state["page_token"] = data["page_token"]
+        checkpoint.set_calendar(
+            calendar_id, {"params": state["params"], "page_token": data["page_token"]}
+        )
+    else:
+        if combined:
+            save_calendar(calendar_id, events)
+        checkpoint.set_calendar(calendar_id, {"done": True})
+        # the last page carries the token for the next incremental run
+        state["sync_token"] = data.get("sync_token", state["sync_token"])
+        state["done"] = True
+
+
+def sync_calendar(calendar_id, sync_token):
+    state = sync_start(calendar_id, sync_token)
+    while not state["done"]:
+        sync_page(state, get(sync_url(state), user_access_token))
+    return state["sync_token"]
 
 
 def work(code):
-    resp = requests.post(
-        "https://open.feishu.cn/open-apis/authen/v1/access_token",
-        headers={"Authorization": f"Bearer {app_access_token}"},
-        json={"grant_type": "authorization_code", "code": code},
-    ).json()
+    # code is None in headless mode, the cached login is used
+    if code is not None:
+        user_token.login(code)
 
+    # the token object is passed to every request and refreshes itself
     global user_access_token
-    user_access_token = resp["data"]["access_token"]
+    user_access_token = user_token
+    metrics.start()
 
     folder = f"{backup_path}/calendar"
     os.makedirs(folder, exist_ok=True)
-    print(f"Output files are written to {folder}")
+
+    global output
+    output = open_output(output_format, backup_path)
+    print(f"Output files are written to {backup_path} as {output_format}")
+
+    global checkpoint
+    checkpoint = Checkpoint(f"{folder}/checkpoint.json", resume=resume)
+
+    try:
+        if engine == "async":
+            asyncio.run(crawl_async())
+        else:
+            crawl()
+    except BaseException:
+        # keep what is done so far for --resume
+        checkpoint.save()
+        output.close()
+        metrics.write(folder)
+        raise
+
+    output.close()
+    print(f"Output: {output.stats()}")
+    checkpoint.remove()
+    for line in throttle.stats():
+        print(f"Throttle {line}")
+    metrics.write(folder)
+    for line in metrics.stats():
+        print(f"Metrics {line}")
+    print("Finished!")
+
+
+def crawl():
+    sync_tokens = load_sync_tokens()
 
     # list calendars
-    calendars = get(
-        "https://open.feishu.cn/open-apis/calendar/v4/calendars?page_size=500",
-        user_access_token,
-    )
-    calendars = calendars["calendar_list"]
+    calendars = get(calendars_url, user_access_token)["calendar_list"]
     print(f"Found {len(calendars)} calendars")
 
+    pool = WorkerPool(jobs, name="calendars")
     for calendar in calendars:
-        calendar_id = calendar["calendar_id"]
-        print(f"Handling calendar {calendar['summary']} {calendar_id}")
+        pool.submit(backup_calendar, calendar, sync_tokens)
+    pool.join()
 
-        page_token = None
-        while True:
-            if page_token is not None:
-                events_url = f"https://open.feishu.cn/open-apis/calendar/v4/calendars/{calendar_id}/events?page_token={page_token}&anchor_time=0"
-            else:
-                events_url = f"https://open.feishu.cn/open-apis/calendar/v4/calendars/{calendar_id}/events?anchor_time=0"
-
-            data = get(
-                events_url,
-                user_access_token,
-            )
-            events = data["items"]
-            print(f"Found {len(events)} events")
-
-            for event in events:
-                # skip cancelled events
-                if event["status"] == "cancelled":
-                    continue
-
-                event_id = event["event_id"]
-                # save raw json
-                with open(
-                    f"{backup_path}/calendar/{event_id}.json", "w", encoding="utf-8"
-                ) as file:
-                    print(json.dumps(event), file=file)
-
-                # save icalendar
-                with open(
-                    f"{backup_path}/calendar/{event_id}.ics", "w", encoding="utf-8"
-                ) as file:
-                    create_time = datetime.fromtimestamp(
-                        int(event["create_time"]), timezone.utc
-                    ).strftime("%Y%m%dT%H%M%SZ")
-                    start_time = parse_time(event["start_time"])
-                    end_time = parse_time(event["end_time"])
-
-                    if "recurrence" in event and len(event['recurrence']) > 0:
-                        recurrence = f"\nRRULE:{event['recurrence']}"
-                    else:
-                        recurrence = ""
-
-                    if "location" in event and "name" in event["location"]:
-                        location = f"\nLOCATION:{event['location']['name']}"
-                    else:
-                        location = ""
-
-                    print(
-                        f"""BEGIN:VCALENDAR
-PRODID:-//Jiajie Chen///feishu-backup v1.0//EN
-VERSION:2.0
-BEGIN:VEVENT
-CREATED:{create_time}
-DTSTAMP:{create_time}
-UID:{event['event_id']}{recurrence}{location}
-DTSTART;{start_time}
-DTEND;{end_time}
-SUMMARY:{event['summary']}
-END:VEVENT
-END:VCALENDAR""",
-                        file=file,
-                    )
 
-            if data["has_more"]:
-                page_token = data["page_token"]
-            else:
-                break
-    print("Finished!")
+def start_calendar(calendar, sync_tokens):
+    # returns False if the calendar is skipped, else its last sync_token
+    calendar_id = calendar["calendar_id"]
+    print(f"Handling calendar {calendar['summary']} {calendar_id}")
+
+    progress = checkpoint.calendar(calendar_id)
+    if progress is not None and progress.get("done"):
+        print("Skipping calendar: finished before resume")
+        return False
+
+    with sync_tokens_lock:
+        return None if full else sync_tokens.get(calendar_id)
+
+
+def finish_calendar(calendar_id, sync_token, sync_tokens):
+    # persist after every calendar, so an interrupted run keeps its progress
+    with sync_tokens_lock:
+        sync_tokens[calendar_id] = sync_token
+        output.flush()
+        save_sync_tokens(sync_tokens)
+
+
+def backup_calendar(calendar, sync_tokens):
+    sync_token = start_calendar(calendar, sync_tokens)
+    if sync_token is False:
+        return
+    calendar_id = calendar["calendar_id"]
+    sync_token = sync_calendar(calendar_id, sync_token)
+    finish_calendar(calendar_id, sync_token, sync_tokens)
+
+
+# --engine async: calendars are coroutines on one event loop,
+# writing the events of a page runs in a thread
+
+
+async def sync_calendar_async(client, calendar_id, sync_token):
+    state = sync_start(calendar_id, sync_token)
+    while not state["done"]:
+        data = await client.get(sync_url(state), user_access_token)
+        await asyncio.to_thread(sync_page, state, data)
+    return state["sync_token"]
+
+
+async def backup_calendar_async(client, calendar, sync_tokens):
+    sync_token = start_calendar(calendar, sync_tokens)
+    if sync_token is False:
+        return
+    calendar_id = calendar["calendar_id"]
+    sync_token = await sync_calendar_async(client, calendar_id, sync_token)
+    await asyncio.to_thread(finish_calendar, calendar_id, sync_token, sync_tokens)
+
+
+async def crawl_async():
+    sync_tokens = load_sync_tokens()
+    client = aiofeishu.Client()
+    try:
+        calendars = (await client.get(calendars_url, user_access_token))[
+            "calendar_list"
+        ]
+        print(f"Found {len(calendars)} calendars")
+
+        # at most jobs calendars at a time, like the WorkerPool of crawl
+        semaphore = asyncio.Semaphore(jobs)
+
+        async def bounded(calendar):
+            async with semaphore:
+                await backup_calendar_async(client, calendar, sync_tokens)
+
+        async with asyncio.TaskGroup() as tasks:
+            for calendar in calendars:
+                tasks.create_task(bounded(calendar))
+    finally:
+        await client.close()
 
 
 class Server(BaseHTTPRequestHandler):
@@ -188,10 +431,94 @@ class Server(BaseHTTPRequestHandler):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Backup feishu calendar events")
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=feishu.pool_size,
+        help="max keep-alive connections to the feishu api",
+    )
+    parser.add_argument(
+        "--base-url",
+        default=feishu.base_url,
+        help="send api requests here instead, e.g. the mock server in benchmarks/",
+    )
+
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="list all events again instead of only the changes since the last run",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue an interrupted run from calendar/checkpoint.json",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=jobs,
+        help="number of calendars fetched concurrently",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["threads", "async"],
+        default=engine,
+        help="async: fetch calendars with asyncio and aiohttp",
+    )
+    parser.add_argument(
+        "--combined",
+        action="store_true",
+        help="write one .ics file with all events per calendar",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=formats,
+        default=output_format,
+        help="dir: one file per event, sqlite/tar: a single append-only archive",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="save a cProfile of the calendar thread to FILE, use with --jobs 1 to include all calendars",
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="start right away with the login cached by an earlier run",
+    )
+    parser.add_argument(
+        "--state-path",
+        default=auth.state_path,
+        help="folder of the cached login, outside backup_path",
+    )
 
     args = parser.parse_args()
 
+    full = args.full
+    headless = args.headless
+    resume = args.resume
+    output_format = args.output_format
+    jobs = args.jobs
+    combined = args.combined
+    engine = args.engine
+    auth.state_path = args.state_path
+    if args.profile is not None:
+        work = metrics.profiled(work, args.profile)
+    feishu.configure(size=max(args.pool_size, jobs), base=args.base_url)
+
     init()
+    if headless:
+        if not user_token.valid():
+            print("No cached user access token, run once without --headless to log in")
+            sys.exit(1)
+        work(None)
+        sys.exit(0)
+
+    state = "backup"
+    redirect_uri = quote("http://127.0.0.1:8888/backup")
+    url = f"https://open.feishu.cn/open-apis/authen/v1/index?redirect_uri={redirect_uri}&app_id={app_id}&state={state}"
+    url = feishu.resolve(url)
+    print(f"Please open {url} in browser")
     server_address = ("", 8888)
     httpd = HTTPServer(server_address, Server)
     try:
@@ -1,32 +1,77 @@
 from threading import Thread
+import asyncio
 from typing import List
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-import sys
+import glob
 import json
 import os
+import sys
 import argparse
+import posixpath
+import requests
 
 from urllib.parse import quote
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from urllib.parse import urlparse, parse_qs
 from secret import *
+import feishu
+import aiofeishu
+import auth
+from auth import UserToken
+import throttle
+import metrics
+from feishu import get
+from worker import WorkerPool, prefetch, prefetch_async
+from manifest import Manifest
+from images import ImageStore
+from cache import LRUCache
+from checkpoint import Checkpoint
+from render import embedded_sheets
+from rawstore import RawStore
+from pipeline import RenderStage, render_all
+from output import open_output, formats
+from batch import Batch, Job, current_job
+from metas import MetaStage, AsyncMetaStage
+from plan import Plan
+from registry import Registry
 
 # docs: https://open.feishu.cn/document/ukTMukTMukTM/uczNzUjL3czM14yN3MTN
 
 app_access_token = ""
 tenant_access_token = ""
-user_access_token = ""
+user_token = None
+headless = False
 filter = None
+jobs = 4
+image_jobs = 8
+full = False
+resume = False
+# threads or async, see crawl_async
+engine = "threads"
+# only report what would be downloaded
+plan = False
+render_jobs = os.cpu_count()
+# shared by the jobs of a batch
+renderer = None
+output_format = "dir"
+# raw responses and downloaded images, below the backup folder of a job by
+# default; an archive backup can keep them out of backup_path
+raw_path = None
+images_path = None
+csv_output = False
+# accounts backed up at the same time, 0 for a single account
+batch_jobs = 0
+batch = None
+# cells per range and per request when exporting sheets
+sheet_range_cells = 10000
+sheet_batch_cells = 50000
+# embedded sheet values kept in memory, in cells, shared by the jobs of a
+# batch but keyed by account: a job only gets values it fetched itself
+sheet_cache = LRUCache(1000000, sizeof=lambda values: sum(map(len, values)))
 
 
 def init():
     # get app_access_token and tenant_access_token
-    resp = requests.post(
-        "https://open.feishu.cn/open-apis/auth/v3/app_access_token/internal",
-        json={"app_id": app_id, "app_secret": app_secret},
-    ).json()
+    resp = auth.app_tokens(app_id, app_secret)
 
     global app_access_token
     app_access_token = resp["app_access_token"]
@@ -37,377 +82,752 @@ def init():
     print("Tenant Access Token:", tenant_access_token)
     print("App Access Token:", app_access_token)
 
+    # cached login of an earlier run, shared by backup.py and backup-calendar.py
+    global user_token
+    auth.move_token(f"{backup_path}/.user_token.json", auth.token_path())
+    user_token = UserToken(auth.token_path(), app_id, app_secret)
 
-# utility
 
+def doc_url(token):
+    return f"https://open.feishu.cn/open-apis/doc/v2/{token}/content"
 
-def get(url, access_token):
-    # retry logic from https://gist.github.com/benjiao/28dc36bd87121b3273e0b3e079a8e8d8
-    retries = Retry()
-    with requests.Session() as s:
-        s.mount("http://", HTTPAdapter(max_retries=retries))
-        s.mount("https://", HTTPAdapter(max_retries=retries))
 
-        resp = s.get(url, headers={"Authorization": f"Bearer {access_token}"})
-        json = resp.json()
-        if json["code"] != 0:
-            print(f"Request to {url} failed with: {json}")
-            sys.exit(1)
-        return json["data"]
-
-
-state = "backup"
-redirect_uri = quote("http://127.0.0.1:8888/backup")
-url = f"https://open.feishu.cn/open-apis/authen/v1/index?redirect_uri={redirect_uri}&app_id={app_id}&state={state}"
-print(f"Please open {url} in browser")
-
-# doc spec
-# https://open.feishu.cn/document/ukTMukTMukTM/uAzM5YjLwMTO24CMzkjN
-
-
-def render_markdown_table(data: List[List[str]]) -> str:
-    text = ""
-    for i, row in enumerate(data):
-        text += "|"
-        for col in row:
-            text += " "
-            if isinstance(col, list):
-                # text run
-                text += "".join(map(lambda v: v["text"], col))
-            else:
-                # string/number
-                text += str(col)
-            text += " |"
-        text += "\n"
-
-        # separator
-        if i == 0:
-            text += "|"
-            text += "-|" * len(row)
-            text += "\n"
-    return text
-
-
-class Dumper:
-    def __init__(self) -> None:
-        self.image_tokens = []
-
-    def print_text_run(self, data) -> str:
-        text_run = data["textRun"]
-        return text_run["text"]
-
-    def print_paragraph(self, data) -> str:
-        paragraph = data["paragraph"]
-        text = ""
-        for element in paragraph["elements"]:
-            text += self.walk(element)
-        if "style" in paragraph:
-            style = paragraph["style"]
-            if "headingLevel" in style:
-                # first heading is title
-                heading_level = style["headingLevel"] + 1
-                text = f'{"#" * heading_level} {text}'
-            if "list" in style:
-                l = style["list"]
-                if l["type"] == "checkBox":
-                    text = f"- [ ] {text}"
-                elif l["type"] == "checkedBox":
-                    text = f"- [x] {text}"
-                elif l["type"] == "number":
-                    text = f'{l["number"]}. {text}'
-                elif l["type"] == "bullet":
-                    text = f"- {text}"
-        return text
-
-    def print_gallery(self, data) -> str:
-        images = data["gallery"]["imageList"]
-        text = ""
-        for image in images:
-            token = image["fileToken"]
-            file_name = f"{token}.png"
-            self.image_tokens.append(token)
-            text += f"![]({file_name})"
-        return text
-
-    def print_table(self, data) -> str:
-        rows = data["table"]["tableRows"]
-        text = ""
-        table_data = []
-        for row in rows:
-            cells = row["tableCells"]
-            row_data = []
-            for cell in cells:
-                body = cell["body"]
-                blocks = body["blocks"]
-                cell_content = ""
-                if blocks != None:
-                    for block in blocks:
-                        cell_content += self.walk(block)
-
-                row_data.append(cell_content)
-            table_data.append(row_data)
-
-        # print table
-        return render_markdown_table(table_data)
-
-    def print_sheet(self, data) -> str:
-        sheet_token = data["sheet"]["token"]
-        # first part is token
-        token = sheet_token.split("_")[0]
-        # second part is sheet id
-        sheet_id = sheet_token.split("_")[1]
-        content = get(
-            f"https://open.feishu.cn/open-apis/sheets/v2/spreadsheets/{token}/values/{sheet_id}?dateTimeRenderOption=FormattedString",
-            user_access_token,
-        )
-        values = content["valueRange"]["values"]
-        # print(values)
-        return render_markdown_table(values)
-
-    def walk(self, data):
-        if data["type"] == "paragraph":
-            return self.print_paragraph(data)
-        elif data["type"] == "textRun":
-            return self.print_text_run(data)
-        elif data["type"] == "gallery":
-            return self.print_gallery(data)
-        elif data["type"] == "table":
-            return self.print_table(data)
-        elif data["type"] == "sheet":
-            return self.print_sheet(data)
-        else:
-            print(f'Unhandled data type {data["type"]}')
-            print(data)
-            return ""
+def docx_blocks_url(token):
+    # https://open.feishu.cn/document/ukTMukTMukTM/uUDN04SN0QjL1QDN/document-docx/docx-v1/document-block/get
+    return f"https://open.feishu.cn/open-apis/docx/v1/documents/{token}/blocks?page_size=500"
+
+
+def sheet_metainfo_url(token):
+    return f"https://open.feishu.cn/open-apis/sheets/v2/spreadsheets/{token}/metainfo"
+
+
+def sheet_values_url(token, sheet_id):
+    return f"https://open.feishu.cn/open-apis/sheets/v2/spreadsheets/{token}/values/{sheet_id}?dateTimeRenderOption=FormattedString"
+
+
+def sheet_batch_url(token, ranges):
+    # https://open.feishu.cn/document/server-docs/docs/sheets-v3/data-operation/reading-multiple-ranges
+    return f'https://open.feishu.cn/open-apis/sheets/v2/spreadsheets/{token}/values_batch_get?ranges={quote(",".join(ranges))}&dateTimeRenderOption=FormattedString'
+
+
+def folder_url(token):
+    # https://open.feishu.cn/document/server-docs/docs/drive-v1/folder/list
+    return f"https://open.feishu.cn/open-apis/drive/v1/files?folder_token={token}&page_size=200"
+
+
+def wiki_nodes_url(space_id, parent_node_token):
+    # https://open.feishu.cn/document/server-docs/docs/wiki-v2/space-node/list
+    url = (
+        f"https://open.feishu.cn/open-apis/wiki/v2/spaces/{space_id}/nodes?page_size=50"
+    )
+    if parent_node_token is not None:
+        url += f"&parent_node_token={parent_node_token}"
+    return url
+
+
+root_folder_url = "https://open.feishu.cn/open-apis/drive/explorer/v2/root_folder/meta"
+wiki_spaces_url = "https://open.feishu.cn/open-apis/wiki/v2/spaces?page_size=50"
 
 
 def save_images(path: str, tokens: List[str]):
+    job = current_job.get()
+    # start all downloads first, they run in parallel on the image store
+    pending = []
     for token in tokens:
-        file_name = f"{token}.png"
-        file_path = f"{backup_path}{path}/{file_name}"
-        if os.path.exists(file_path):
+        file_path = f"{path}/{token}.png"
+        if job.output.exists(file_path):
             continue
-        with open(f"{backup_path}{path}/{file_name}", "wb") as file:
-            url = f"https://open.feishu.cn/open-apis/drive/v1/medias/{token}/download"
-            print(f"Downloading image {token}")
-            resp = requests.get(
-                url, headers={"Authorization": f"Bearer {user_access_token}"}
-            )
-            file.write(resp.content)
+        job.checkpoint.start_image(token)
+        pending.append((file_path, token, job.images.fetch(token, job.user_token)))
+
+    for file_path, token, future in pending:
+        try:
+            future.result()
+        except (requests.RequestException, OSError) as e:
+            # a missing or forbidden image does not fail the document, it
+            # stays pending in the checkpoint
+            print(f"Failed to download image {token}: {e}")
+            continue
+        job.output.add_file(file_path, job.images.path(token))
+        job.checkpoint.finish_image(token)
 
 
-def save_doc(path, file_name, token):
-    # fetch content
-    file = get(
-        f"https://open.feishu.cn/open-apis/doc/v2/{token}/content", user_access_token
+def sheet_values(token, sheet_id):
+    # the same tab is often embedded in many docs, fetch it once per run
+    job = current_job.get()
+
+    def load():
+        content = get(sheet_values_url(token, sheet_id), job.user_token)
+        return content["valueRange"]["values"]
+
+    return sheet_cache.get((job.root, token, sheet_id), load)
+
+
+def render(path, file_name, token, obj_type, then):
+    # hand the saved raw responses to the rendering stage and return, the
+    # rendered files and the images are saved in a finisher thread and
+    # then() is called; blocks while the renderers are behind
+    job = current_job.get()
+    render_dir = job.output.render_dir(path)
+
+    def rendered(result):
+        image_tokens, files = result
+        job.output.commit_dir(path, render_dir, files)
+        save_images(path, image_tokens)
+        then()
+
+    job.pool.track(
+        job.renderer.submit(
+            job.raw_store.path(token), render_dir, file_name, obj_type, rendered
+        )
     )
-    content = file["content"]
 
-    dumper = Dumper()
-    content = json.loads(content)
-    title = content["title"]["elements"]
-    text = ""
-    for element in title:
-        text += f"# {dumper.walk(element)}"
-    text += "\n"
-    blocks = content["body"]["blocks"]
-    for block in blocks:
-        text += dumper.walk(block)
-        text += "\n"
-    os.makedirs(f"{backup_path}{path}", exist_ok=True)
-    with open(f"{backup_path}{path}/{file_name}", "w") as f:
-        f.write(text)
 
-    save_images(path, dumper.image_tokens)
+def save_doc(path, file_name, token):
+    # fetch content
+    job = current_job.get()
+    file = get(doc_url(token), job.user_token)
+    content = json.loads(file["content"])
+
+    with job.raw_store.writer(
+        token, {"type": "doc", "content": file["content"]}
+    ) as raw:
+        # embedded sheets are saved with the doc so it renders offline
+        for sheet_token, sheet_id in embedded_sheets(content):
+            values = sheet_values(sheet_token, sheet_id)
+            raw.write({"sheet": f"{sheet_token}_{sheet_id}", "values": values})
 
 
 def save_docx(path, file_name, token):
     # fetch content
-    # https://open.feishu.cn/document/ukTMukTMukTM/uUDN04SN0QjL1QDN/document-docx/docx-v1/document-block/get
-    # TODO: handle paging
-    file = get(
-        f"https://open.feishu.cn/open-apis/docx/v1/documents/{token}/blocks",
-        user_access_token,
-    )
-
-    content = file["items"]
-    text = ""
-    image_tokens = []
-    for block in content:
-        # https://open.feishu.cn/document/ukTMukTMukTM/uUDN04SN0QjL1QDN/document-docx/docx-structure#2c5327a4
-        block_type = block["block_type"]
-        if block_type == 1:
-            # page
-            text += "# "
-            for text_run in block["page"]["elements"]:
-                text += text_run["text_run"]["content"]
-            text += "\n"
-        elif block_type == 2:
-            # text
-            for text_run in block["text"]["elements"]:
-                if "text_run" in text_run:
-                    text += text_run["text_run"]["content"]
-            text += "\n"
-        elif block_type == 3:
-            # heading 1
-            text += "# "
-            for text_run in block["heading1"]["elements"]:
-                text += text_run["text_run"]["content"]
-            text += "\n"
-        elif block_type == 4:
-            # heading 2
-            text += "## "
-            for text_run in block["heading2"]["elements"]:
-                text += text_run["text_run"]["content"]
-            text += "\n"
-        elif block_type == 5:
-            # heading 3
-            text += "### "
-            for text_run in block["heading3"]["elements"]:
-                text += text_run["text_run"]["content"]
-            text += "\n"
-        elif block_type == 12:
-            # bullet
-            text += "- "
-            for text_run in block["bullet"]["elements"]:
-                text += text_run["text_run"]["content"]
-            text += "\n"
-        elif block_type == 13:
-            # ordered list
-            text += "1. "
-            for text_run in block["ordered"]["elements"]:
-                text += text_run["text_run"]["content"]
-            text += "\n"
-        elif block_type == 14:
-            # code
-            text += "```\n"
-            for text_run in block["code"]["elements"]:
-                text += text_run["text_run"]["content"]
-            text += "\n"
-            text += "```\n"
-        elif block_type == 27:
-            image_token = block["image"]["token"]
-            image_tokens.append(image_token)
-
-            image_name = f"{image_token}.png"
-            text += f"![]({image_name})"
-            text += "\n"
+    # blocks are streamed to the raw store page by page as they arrive
+    job = current_job.get()
+    pages = feishu.pages(docx_blocks_url(token), job.user_token)
+
+    with job.raw_store.writer(token, {"type": "docx"}) as raw:
+        for page in pages:
+            for block in page["items"]:
+                raw.write(block)
+
+
+def column_name(index):
+    # 1 -> A, 27 -> AA
+    name = ""
+    while index > 0:
+        index, rem = divmod(index - 1, 26)
+        name = chr(ord("A") + rem) + name
+    return name
+
+
+def sheet_ranges(sheets):
+    # split every tab into row ranges of about sheet_range_cells cells
+    # yields (index of the tab, range, cells), empty tabs get a None range
+    for index, sheet in enumerate(sheets):
+        rows = sheet.get("rowCount", 0)
+        columns = max(sheet.get("columnCount", 0), 1)
+        if rows == 0:
+            yield index, None, 0
+            continue
+        step = max(1, sheet_range_cells // columns)
+        for start in range(1, rows + 1, step):
+            end = min(start + step - 1, rows)
+            cells = (end - start + 1) * columns
+            yield index, f'{sheet["sheetId"]}!A{start}:{column_name(columns)}{end}', cells
+
+
+def sheet_batches(sheets):
+    # group ranges into requests of at most sheet_batch_cells cells
+    batch = []
+    batch_cells = 0
+    for index, range, cells in sheet_ranges(sheets):
+        if len(batch) > 0 and batch_cells + cells > sheet_batch_cells:
+            yield batch
+            batch = []
+            batch_cells = 0
+        batch.append((index, range))
+        batch_cells += cells
+    if len(batch) > 0:
+        yield batch
+
+
+def fetch_sheet_batch(token, batch):
+    ranges = [range for _, range in batch if range is not None]
+    value_ranges = []
+    if len(ranges) > 0:
+        content = get(sheet_batch_url(token, ranges), current_job.get().user_token)
+        value_ranges = content["valueRanges"]
+    return sheet_records(batch, value_ranges)
+
+
+def sheet_records(batch, value_ranges):
+    # raw store records
+    result = []
+    for index, range in batch:
+        if range is None:
+            result.append({"sheet": index, "values": []})
         else:
-            print(f"Unhandled block type {block_type}")
-            print(block)
-
-    os.makedirs(f"{backup_path}{path}", exist_ok=True)
-    with open(f"{backup_path}{path}/{file_name}", "w") as f:
-        f.write(text)
-    save_images(path, image_tokens)
+            values = value_ranges.pop(0).get("values") or []
+            result.append({"sheet": index, "values": values})
+    return result
 
 
 def save_sheet(path, file_name, token):
-    metainfo = get(
-        f"https://open.feishu.cn/open-apis/sheets/v2/spreadsheets/{token}/metainfo",
-        user_access_token,
-    )
+    job = current_job.get()
+    metainfo = get(sheet_metainfo_url(token), job.user_token)
     sheets = metainfo["sheets"]
-    text = ""
-    for sheet in sheets:
-        sheet_id = sheet["sheetId"]
-
-        text += f'# {sheet["title"]}\n'
-        content = get(
-            f"https://open.feishu.cn/open-apis/sheets/v2/spreadsheets/{token}/values/{sheet_id}?dateTimeRenderOption=FormattedString",
-            user_access_token,
+    batches = prefetch(
+        lambda batch: fetch_sheet_batch(token, batch), sheet_batches(sheets)
+    )
+
+    with job.raw_store.writer(token, {"type": "sheet", "sheets": sheets}) as raw:
+        for batch in batches:
+            for record in batch:
+                raw.write(record)
+
+
+savers = {
+    "doc": save_doc,
+    "docx": save_docx,
+    "sheet": save_sheet,
+}
+
+
+def wanted(path, name, obj_type, token) -> bool:
+    abs_path = f"{path}/{name}.md"
+    if obj_type not in savers:
+        print(f"Unsupported type: {obj_type}")
+        return False
+
+    # filter
+    if filter is not None:
+        if token not in filter:
+            print(f"Skipping {abs_path}: token {token} not matching")
+            return False
+    return True
+
+
+def find_file(path, name, obj_type, token, revision):
+    # the metadata stage calls backup_file with the latest revision
+    if wanted(path, name, obj_type, token):
+        current_job.get().metas.add(path, name, obj_type, token, revision)
+
+
+def modified(path, name, token, revision) -> bool:
+    job = current_job.get()
+    abs_path = f"{path}/{name}.md"
+    if job.manifest.unchanged(token, revision, abs_path) and job.output.exists(
+        abs_path
+    ):
+        print(f"Skipping {abs_path}: not modified")
+        return False
+
+    if job.checkpoint.document_done(abs_path):
+        print(f"Skipping {abs_path}: finished before resume")
+        return False
+
+    print(f"Downloading {abs_path}")
+    return True
+
+
+def save_links(links):
+    # a document found again at another location points to the saved copy
+    job = current_job.get()
+    for location, canonical in links:
+        relative = posixpath.relpath(canonical, posixpath.dirname(location))
+        name = posixpath.splitext(posixpath.basename(location))[0]
+        job.output.write(
+            location, f"# {name}\n\nSaved at [{canonical}]({quote(relative)})\n"
         )
-        values = content["valueRange"]["values"]
-        text += render_markdown_table(values)
 
-    os.makedirs(f"{backup_path}{path}", exist_ok=True)
-    with open(f"{backup_path}{path}/{file_name}", "w") as f:
-        f.write(text)
+
+def backup_file(path, name, obj_type, token, revision):
+    save, links = current_job.get().registry.claim(
+        path, name, obj_type, token, revision
+    )
+    save_links(links)
+    if save:
+        submit_file(path, name, obj_type, token, revision)
 
 
-def list_folder(path, token):
-    children = get(
-        f"https://open.feishu.cn/open-apis/drive/explorer/v2/folder/{token}/children",
-        user_access_token,
+def submit_file(path, name, obj_type, token, revision):
+    if modified(path, name, token, revision):
+        current_job.get().pool.submit(
+            save_file, path, f"{name}.md", obj_type, token, revision
+        )
+
+
+def save_file(path, file_name, obj_type, token, revision):
+    # the worker moves on to the next document once the raw responses are
+    # saved, rendering and images run in the render stage
+    savers[obj_type](path, file_name, token)
+    render(
+        path,
+        file_name,
+        token,
+        obj_type,
+        lambda: finish_file(path, file_name, obj_type, token, revision),
     )
 
-    for token in children["children"]:
-        data = children["children"][token]
+
+def finish_file(path, file_name, obj_type, token, revision):
+    job = current_job.get()
+    # only record the revision once the file is completely written
+    job.manifest.update(token, obj_type, revision, f"{path}/{file_name}")
+    job.checkpoint.finish_document(f"{path}/{file_name}")
+    metrics.document(obj_type)
+
+
+def list_items(key, url, field, token_field="page_token"):
+    # all items of a paged listing, reused from the checkpoint on resume
+    job = current_job.get()
+    items = job.checkpoint.listing(key)
+    if items is None:
+        items = []
+        for page in feishu.pages(url, job.user_token, token_field):
+            items.extend(page.get(field) or [])
+            if job.plan is not None:
+                job.plan.count_listing()
+        job.checkpoint.set_listing(key, items)
+    return items
+
+
+def folder_entries(path, children):
+    # ("folder", path, token) or ("file", path, name, obj_type, token, revision)
+    for data in children:
         if data["type"] == "folder":
-            list_folder(f'{path}/{data["name"]}', token)
+            yield "folder", f'{path}/{data["name"]}', data["token"]
+        elif data["type"] == "shortcut":
+            target = data["shortcut_info"]
+            yield "file", path, data["name"], target["target_type"], target[
+                "target_token"
+            ], data.get("modified_time")
+        else:
+            yield "file", path, data["name"], data["type"], data["token"], data.get(
+                "modified_time"
+            )
+
+
+def wiki_entries(path, nodes):
+    # ("file", path, name, obj_type, token, revision) or ("folder", path, node)
+    for item in nodes:
+        yield "file", path, item["title"], item["obj_type"], item[
+            "obj_token"
+        ], item.get("obj_edit_time")
+        # children are saved in a folder named after the parent node
+        if item.get("has_child"):
+            yield "folder", f'{path}/{item["title"]}', item["node_token"]
+
+
+def list_folder(path, token):
+    children = list_items(
+        f"folder:{token}", folder_url(token), "files", "next_page_token"
+    )
+    for kind, *entry in folder_entries(path, children):
+        if kind == "folder":
+            list_folder(*entry)
         else:
-            abs_path = f'{path}/{data["name"]}.md'
-            # filter
-            if filter is not None:
-                if token not in filter:
-                    print(f"Skipping {abs_path}: token {token} not matching")
-                    continue
-
-            print(f"Downloading {abs_path}")
-            file_name = f'{data["name"]}.md'
-            if data["type"] == "doc":
-                save_doc(path, file_name, data["token"])
-                pass
-            elif data["type"] == "docx":
-                save_docx(path, file_name, data["token"])
-                pass
-            elif data["type"] == "sheet":
-                save_sheet(path, file_name, data["token"])
-                pass
-            else:
-                print(f'Unsupported type: {data["type"]}')
+            find_file(*entry)
+
+
+def list_wiki_nodes(path, space_id, parent_node_token):
+    nodes = list_items(
+        f"wiki:{space_id}:{parent_node_token}",
+        wiki_nodes_url(space_id, parent_node_token),
+        "items",
+    )
+    for kind, *entry in wiki_entries(path, nodes):
+        if kind == "folder":
+            list_wiki_nodes(entry[0], space_id, entry[1])
+        else:
+            find_file(*entry)
 
 
 def work(code):
-    resp = requests.post(
-        "https://open.feishu.cn/open-apis/authen/v1/access_token",
-        headers={"Authorization": f"Bearer {app_access_token}"},
-        json={"grant_type": "authorization_code", "code": code},
-    ).json()
+    # code is None in headless mode, the cached login is used
+    if code is not None:
+        user_token.login(code)
+
+    metrics.start()
+    job = Job("", backup_path, user_token)
+    if plan:
+        plan_run(job)
+        return
+
+    job.renderer = RenderStage(render_jobs, csv=csv_output)
+    try:
+        run(job)
+    finally:
+        job.renderer.close()
+
+
+def job_folder(path, job, name):
+    # path of --raw-path or --images-path, every batch account gets a folder
+    if path is None:
+        return f"{job.root}/{name}"
+    return path + job.root.removeprefix(backup_path)
+
+
+def run(job):
+    # backup of one account into job.root
+    current_job.set(job)
+    os.makedirs(job.root, exist_ok=True)
+    job.checkpoint = Checkpoint(f"{job.root}/checkpoint.json", resume=resume)
+    job.manifest = Manifest(f"{job.root}/manifest.json", full=full)
+    job.checkpoint.manifest = job.manifest
+    job.images = ImageStore(job_folder(images_path, job, ".images"), jobs=image_jobs)
+    job.raw_store = RawStore(job_folder(raw_path, job, ".raw"))
+    job.output = open_output(output_format, job.root)
+    job.registry = Registry(job.manifest.paths())
 
-    global user_access_token
-    user_access_token = resp["data"]["access_token"]
+    try:
+        if engine == "async":
+            asyncio.run(crawl_async())
+        else:
+            job.metas = MetaStage(backup_file, job.user_token)
+            # folder listing runs here and feeds documents to the workers
+            job.pool = WorkerPool(jobs, name="documents")
+            crawl()
+    except BaseException:
+        # keep what is done so far for --resume
+        job.checkpoint.save()
+        job.manifest.set_links(job.registry.all_links())
+        job.manifest.save()
+        job.output.close()
+        metrics.write(backup_path)
+        raise
+
+    job.images.close()
+    job.output.close()
+    print(f"Output: {job.output.stats()}")
+    print(f"Documents found again at other locations: {job.registry.duplicates()}")
+    job.manifest.set_links(job.registry.all_links())
+    job.manifest.save()
+    job.checkpoint.remove()
+    print(f"Embedded sheet cache: {sheet_cache.stats()}")
+    for line in throttle.stats():
+        print(f"Throttle {line}")
+    # cumulative over all jobs of a batch
+    metrics.write(backup_path)
+    for line in metrics.stats():
+        print(f"Metrics {line}")
+    print("Finished!")
+
+
+def plan_run(job):
+    # walk the tree like run() without downloading or writing anything
+    current_job.set(job)
+    job.checkpoint = Checkpoint(f"{job.root}/checkpoint.json", interval=float("inf"))
+    job.manifest = Manifest(f"{job.root}/manifest.json", full=full)
+    job.plan = Plan()
+    job.metas = MetaStage(job.plan.add, job.user_token)
+    job.pool = WorkerPool(jobs)
+    crawl()
+    job.plan.report(job.manifest, job.metas.calls)
+
+
+def crawl():
+    job = current_job.get()
+    # images interrupted in the last run are resumed first
+    for token in job.checkpoint.pending_images():
+        job.images.fetch(token, job.user_token)
 
     # list documents
-    root_folder = get(
-        "https://open.feishu.cn/open-apis/drive/explorer/v2/root_folder/meta",
-        user_access_token,
-    )
+    root_folder = get(root_folder_url, job.user_token)
     folder_token = root_folder["token"]
     # print(f'Found Root folder token: {folder_token}, id: {root_folder["id"]}')
 
     list_folder("", folder_token)
 
-    # list wikis
-    # TODO: paging
-    wikis = get(
-        "https://open.feishu.cn/open-apis/wiki/v2/spaces?page_size=10",
-        user_access_token,
-    )
-    for item in wikis["items"]:
-        space_name = item["name"]
-        print(f"Found wiki space {space_name}")
-        space_id = item["space_id"]
-
-        # get nodes
-        nodes = get(
-            f"https://open.feishu.cn/open-apis/wiki/v2/spaces/{space_id}/nodes?page_size=10",
-            user_access_token,
+    # list wikis, spaces are crawled in parallel
+    spaces = WorkerPool(jobs, name="wiki spaces")
+    for item in list_items("wiki", wiki_spaces_url, "items"):
+        print(f'Found wiki space {item["name"]}')
+        spaces.submit(list_wiki_nodes, f'/知识库/{item["name"]}', item["space_id"], None)
+    spaces.join()
+
+    job.metas.flush()
+    if job.registry is not None:
+        # documents not found at their location of the last run
+        for args, links in job.registry.resolve():
+            save_links(links)
+            submit_file(*args)
+    job.pool.join()
+
+
+# --engine async: the same crawl as coroutines on one event loop per job,
+# requests go through aiofeishu; rendering and output stay in threads
+
+
+async def fetch_image_async(token) -> bool:
+    # like save_images, a missing or forbidden image does not fail the
+    # document or the crawl, it stays pending in the checkpoint
+    job = current_job.get()
+    try:
+        await job.images.fetch_async(job.client, token, job.user_token)
+    except (aiofeishu.aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+        print(f"Failed to download image {token}: {e}")
+        return False
+    return True
+
+
+async def save_images_async(path, tokens):
+    job = current_job.get()
+
+    async def save_image(file_path, token):
+        if not await fetch_image_async(token):
+            return
+        await asyncio.to_thread(job.output.add_file, file_path, job.images.path(token))
+        job.checkpoint.finish_image(token)
+
+    async with asyncio.TaskGroup() as tasks:
+        for token in tokens:
+            file_path = f"{path}/{token}.png"
+            if job.output.exists(file_path):
+                continue
+            job.checkpoint.start_image(token)
+            tasks.create_task(save_image(file_path, token))
+
+
+async def sheet_values_async(token, sheet_id):
+    job = current_job.get()
+
+    async def load():
+        content = await job.client.get(
+            sheet_values_url(token, sheet_id), job.user_token
         )
-        for item in nodes["items"]:
-            if item["obj_type"] == "doc":
-                path = f"/知识库/{space_name}"
-                abs_path = f'{path}/{item["title"]}.md'
-                print(f"Downloading {abs_path}")
-                file = get(
-                    f'https://open.feishu.cn/open-apis/doc/v2/{item["obj_token"]}/content',
-                    user_access_token,
+        return content["valueRange"]["values"]
+
+    return await sheet_cache.get_async((job.root, token, sheet_id), load)
+
+
+async def submit_render_async(path, file_name, token, obj_type):
+    # waits in a thread while the renderers are behind, returns an awaitable
+    # of the image tokens once the document is handed over
+    job = current_job.get()
+    render_dir = await asyncio.to_thread(job.output.render_dir, path)
+    future = await asyncio.to_thread(
+        job.renderer.submit,
+        job.raw_store.path(token),
+        render_dir,
+        file_name,
+        obj_type,
+        lambda result: result,
+    )
+
+    async def rendered():
+        image_tokens, files = await asyncio.wrap_future(future)
+        await asyncio.to_thread(job.output.commit_dir, path, render_dir, files)
+        return image_tokens
+
+    return rendered()
+
+
+async def save_doc_async(path, file_name, token):
+    job = current_job.get()
+    file = await job.client.get(doc_url(token), job.user_token)
+    content = json.loads(file["content"])
+    sheets = [
+        (f"{sheet_token}_{sheet_id}", await sheet_values_async(sheet_token, sheet_id))
+        for sheet_token, sheet_id in embedded_sheets(content)
+    ]
+
+    with job.raw_store.writer(
+        token, {"type": "doc", "content": file["content"]}
+    ) as raw:
+        for sheet, values in sheets:
+            raw.write({"sheet": sheet, "values": values})
+
+
+async def save_docx_async(path, file_name, token):
+    job = current_job.get()
+    with job.raw_store.writer(token, {"type": "docx"}) as raw:
+        async for page in job.client.pages(docx_blocks_url(token), job.user_token):
+            for block in page["items"]:
+                raw.write(block)
+
+
+async def fetch_sheet_batch_async(token, batch):
+    job = current_job.get()
+    ranges = [range for _, range in batch if range is not None]
+    value_ranges = []
+    if len(ranges) > 0:
+        content = await job.client.get(sheet_batch_url(token, ranges), job.user_token)
+        value_ranges = content["valueRanges"]
+    return sheet_records(batch, value_ranges)
+
+
+async def save_sheet_async(path, file_name, token):
+    job = current_job.get()
+    metainfo = await job.client.get(sheet_metainfo_url(token), job.user_token)
+    sheets = metainfo["sheets"]
+    batches = prefetch_async(
+        lambda batch: fetch_sheet_batch_async(token, batch), sheet_batches(sheets)
+    )
+
+    with job.raw_store.writer(token, {"type": "sheet", "sheets": sheets}) as raw:
+        async for batch in batches:
+            for record in batch:
+                raw.write(record)
+
+
+async_savers = {
+    "doc": save_doc_async,
+    "docx": save_docx_async,
+    "sheet": save_sheet_async,
+}
+
+
+async def find_file_async(path, name, obj_type, token, revision):
+    if wanted(path, name, obj_type, token):
+        await current_job.get().metas.add(path, name, obj_type, token, revision)
+
+
+async def backup_file_async(path, name, obj_type, token, revision):
+    save, links = current_job.get().registry.claim(
+        path, name, obj_type, token, revision
+    )
+    await asyncio.to_thread(save_links, links)
+    if save:
+        await submit_file_async(path, name, obj_type, token, revision)
+
+
+async def submit_file_async(path, name, obj_type, token, revision):
+    job = current_job.get()
+    if modified(path, name, token, revision):
+        # like WorkerPool.submit, the crawl waits while jobs documents are saved
+        await job.slots.acquire()
+        metrics.queue("documents", 1)
+        job.tasks.create_task(
+            save_file_async(path, f"{name}.md", obj_type, token, revision)
+        )
+
+
+async def save_file_async(path, file_name, obj_type, token, revision):
+    # like save_file, the slot is free for the next document once this one
+    # is handed to the render stage
+    job = current_job.get()
+    try:
+        await async_savers[obj_type](path, file_name, token)
+        rendered = await submit_render_async(path, file_name, token, obj_type)
+    finally:
+        metrics.queue("documents", -1)
+        job.slots.release()
+    await save_images_async(path, await rendered)
+    finish_file(path, file_name, obj_type, token, revision)
+
+
+async def list_items_async(key, url, field, token_field="page_token"):
+    job = current_job.get()
+    items = job.checkpoint.listing(key)
+    if items is None:
+        items = []
+        async for page in job.client.pages(url, job.user_token, token_field):
+            items.extend(page.get(field) or [])
+        job.checkpoint.set_listing(key, items)
+    return items
+
+
+async def list_folder_async(path, token, listing):
+    # subfolders are listed concurrently as tasks of listing
+    children = await list_items_async(
+        f"folder:{token}", folder_url(token), "files", "next_page_token"
+    )
+    for kind, *entry in folder_entries(path, children):
+        if kind == "folder":
+            listing.create_task(list_folder_async(*entry, listing))
+        else:
+            await find_file_async(*entry)
+
+
+async def list_wiki_nodes_async(path, space_id, parent_node_token, listing):
+    nodes = await list_items_async(
+        f"wiki:{space_id}:{parent_node_token}",
+        wiki_nodes_url(space_id, parent_node_token),
+        "items",
+    )
+    for kind, *entry in wiki_entries(path, nodes):
+        if kind == "folder":
+            listing.create_task(
+                list_wiki_nodes_async(entry[0], space_id, entry[1], listing)
+            )
+        else:
+            await find_file_async(*entry)
+
+
+async def crawl_async():
+    job = current_job.get()
+    job.client = aiofeishu.Client()
+    job.slots = asyncio.Semaphore(jobs)
+    job.metas = AsyncMetaStage(backup_file_async, job.client, job.user_token)
+    try:
+        # documents and images outlive the listing
+        async with asyncio.TaskGroup() as job.tasks:
+            # images interrupted in the last run are resumed first
+            for token in job.checkpoint.pending_images():
+                job.tasks.create_task(fetch_image_async(token))
+
+            root_folder = await job.client.get(root_folder_url, job.user_token)
+            async with asyncio.TaskGroup() as listing:
+                listing.create_task(
+                    list_folder_async("", root_folder["token"], listing)
                 )
-                save_doc(path, f'{item["title"]}.md', file["content"])
+                for item in await list_items_async("wiki", wiki_spaces_url, "items"):
+                    print(f'Found wiki space {item["name"]}')
+                    listing.create_task(
+                        list_wiki_nodes_async(
+                            f'/知识库/{item["name"]}', item["space_id"], None, listing
+                        )
+                    )
+            await job.metas.flush()
+            # documents not found at their location of the last run
+            for args, links in job.registry.resolve():
+                await asyncio.to_thread(save_links, links)
+                await submit_file_async(*args)
+    finally:
+        await job.client.close()
+
+
+def account_job(token, root):
+    # batch mode: every account is backed up into its own folder
+    name = token.data.get("name") or os.path.basename(root)
+    job = Job(name, root, token)
+    job.renderer = renderer
+    return job
+
+
+def batch_login(code):
+    token = UserToken(None, app_id, app_secret)
+    token.login(code)
+    account = token.data["open_id"]
+    # the login is kept for later headless batch runs
+    token.file_path = auth.token_path(account)
+    token.save()
+    batch.submit(account_job(token, f"{backup_path}/{account}"))
+
+
+def cached_accounts():
+    # accounts that logged in during an earlier batch run
+    for file_path in glob.glob(f"{backup_path}/*/.user_token.json"):
+        account = os.path.basename(os.path.dirname(file_path))
+        auth.move_token(file_path, auth.token_path(account))
+    for file_path in sorted(glob.glob(auth.token_path("*"))):
+        account = os.path.basename(file_path).removesuffix(".json")
+        token = UserToken(file_path, app_id, app_secret)
+        if token.valid():
+            yield account_job(token, f"{backup_path}/{account}")
+        else:
+            print(f"Skipping {file_path}: login expired")
 
 
 class Server(BaseHTTPRequestHandler):
     def do_GET(self):
+        if batch is not None and urlparse(self.path).path == "/":
+            self.send_response(200)
+            self.send_header("Content-type", "text/html; charset=utf-8")
+            self.end_headers()
+            self.wfile.write(batch.status_page().encode("utf-8"))
+            return
+
         self.send_response(200)
         self.send_header("Content-type", "text/html")
         self.end_headers()
@@ -418,7 +838,10 @@ class Server(BaseHTTPRequestHandler):
             return
 
         code = code[0]
-        thread = Thread(target=work, args=(code,))
+        if batch is not None:
+            thread = Thread(target=batch_login, args=(code,))
+        else:
+            thread = Thread(target=work, args=(code,))
         thread.start()
 
 
@@ -430,6 +853,118 @@ if __name__ == "__main__":
         nargs="+",
         help="only download the files matching the token",
     )
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=feishu.pool_size,
+        help="max keep-alive connections to the feishu api",
+    )
+    parser.add_argument(
+        "--base-url",
+        default=feishu.base_url,
+        help="send api requests here instead, e.g. the mock server in benchmarks/",
+    )
+
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=jobs,
+        help="number of documents to download concurrently, 1 to run sequentially",
+    )
+
+    parser.add_argument(
+        "--engine",
+        choices=["threads", "async"],
+        default=engine,
+        help="async: crawl with asyncio and aiohttp, --plan always uses threads",
+    )
+
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="download every file even if it is not modified since the last run",
+    )
+
+    parser.add_argument(
+        "--image-jobs",
+        type=int,
+        default=image_jobs,
+        help="number of images to download concurrently",
+    )
+
+    parser.add_argument(
+        "--csv",
+        action="store_true",
+        help="also save every sheet tab as csv next to the markdown file",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue an interrupted run from backup_path/checkpoint.json",
+    )
+
+    parser.add_argument(
+        "--render-only",
+        action="store_true",
+        help="render all markdown again from the saved raw responses, without network",
+    )
+
+    parser.add_argument(
+        "--render-jobs",
+        type=int,
+        default=render_jobs,
+        help="number of processes rendering markdown, 0 to render in the download threads",
+    )
+
+    parser.add_argument(
+        "--output-format",
+        choices=formats,
+        default=output_format,
+        help="dir: one file per document, sqlite/tar: a single append-only archive",
+    )
+
+    parser.add_argument(
+        "--raw-path",
+        help="folder of the raw api responses, default backup_path/.raw",
+    )
+
+    parser.add_argument(
+        "--images-path",
+        help="folder of the downloaded images, default backup_path/.images",
+    )
+
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="start right away with the login cached by an earlier run",
+    )
+
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="save a cProfile of the crawl thread to FILE, use with --jobs 1 to include downloads",
+    )
+
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="list documents and report what would be downloaded, without downloading",
+    )
+
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=batch_jobs,
+        metavar="N",
+        help="back up every account that logs in, N at a time, each into backup_path/<open_id>",
+    )
+
+    parser.add_argument(
+        "--state-path",
+        default=auth.state_path,
+        help="folder of the cached logins, outside backup_path",
+    )
 
     args = parser.parse_args()
 
@@ -437,7 +972,64 @@ if __name__ == "__main__":
         filter = args.filter
         print(f"Only download file with id in {filter}")
 
+    jobs = args.jobs
+    engine = args.engine
+    image_jobs = args.image_jobs
+    full = args.full
+    headless = args.headless
+    resume = args.resume
+    csv_output = args.csv
+    render_jobs = args.render_jobs
+    output_format = args.output_format
+    raw_path = args.raw_path
+    images_path = args.images_path
+    batch_jobs = args.batch
+    plan = args.plan
+    auth.state_path = args.state_path
+    if args.profile is not None:
+        work = metrics.profiled(work, args.profile)
+    # every worker needs its own connection
+    feishu.configure(
+        size=max(args.pool_size, max(batch_jobs, 1) * (jobs + image_jobs)),
+        base=args.base_url,
+    )
+
+    if args.render_only:
+        render_all(
+            Manifest(f"{backup_path}/manifest.json"),
+            RawStore(raw_path or f"{backup_path}/.raw"),
+            images_path or f"{backup_path}/.images",
+            open_output(output_format, backup_path),
+            jobs=render_jobs,
+            csv=csv_output,
+        )
+        sys.exit(0)
+
     init()
+    if batch_jobs > 0:
+        batch = Batch(plan_run if plan else run, jobs=batch_jobs)
+        metrics.start()
+        renderer = RenderStage(render_jobs, csv=csv_output)
+        if headless:
+            for job in cached_accounts():
+                batch.submit(job)
+            finished = batch.wait()
+            renderer.close()
+            sys.exit(0 if finished else 1)
+    elif headless:
+        if not user_token.valid():
+            print("No cached user access token, run once without --headless to log in")
+            sys.exit(1)
+        work(None)
+        sys.exit(0)
+
+    state = "backup"
+    redirect_uri = quote("http://127.0.0.1:8888/backup")
+    url = f"https://open.feishu.cn/open-apis/authen/v1/index?redirect_uri={redirect_uri}&app_id={app_id}&state={state}"
+    url = feishu.resolve(url)
+    print(f"Please open {url} in browser")
+    if batch is not None:
+        print("Batch status on http://127.0.0.1:8888/")
     server_address = ("", 8888)
     httpd = HTTPServer(server_address, Server)
     try:
@@ -0,0 +1,132 @@
+import contextvars
+import html
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# batch mode: every authorized account is an isolated job with its own token,
+# backup folder, manifest and checkpoint; a few jobs run at a time over the
+# shared connection pool, rate limiter and render processes
+
+# the job the current thread works for
+# worker.WorkerPool and worker.prefetch carry it into their threads
+current_job = contextvars.ContextVar("current_job")
+
+
+class Job:
+    def __init__(self, name, root, user_token) -> None:
+        self.name = name
+        # backup_path of the account
+        self.root = root
+        self.user_token = user_token
+        self.status = "queued"
+        self.error = None
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # set up when the job starts
+        self.checkpoint = None
+        self.manifest = None
+        self.images = None
+        self.raw_store = None
+        self.output = None
+        self.renderer = None
+        self.pool = None
+        self.metas = None
+        self.registry = None
+        # --engine async: aiofeishu.Client, TaskGroup of the documents and
+        # the semaphore bounding them
+        self.client = None
+        self.tasks = None
+        self.slots = None
+        # --plan report
+        self.plan = None
+
+
+class Batch:
+    def __init__(self, run, jobs=2) -> None:
+        # run(job) does the backup of one account
+        self.run = run
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.lock = threading.Lock()
+        self.jobs = []
+        self.futures = []
+
+    def submit(self, job):
+        with self.lock:
+            # authorizing again while the account is queued or running is a no-op
+            for other in self.jobs:
+                if other.root == job.root and other.status in ["queued", "running"]:
+                    print(f"Job {job.name} is already {other.status}")
+                    return other
+            print(f"Queued job {job.name}")
+            self.jobs.append(job)
+            self.futures.append(self.executor.submit(self.start, job))
+        return job
+
+    def start(self, job):
+        job.status = "running"
+        job.started_at = time.time()
+        print(f"Starting job {job.name}")
+        try:
+            # a fresh context per job, nothing is shared with the last one
+            contextvars.Context().run(self.run, job)
+            job.status = "finished"
+        except BaseException as e:
+            # feishu.get exits on api errors, keep the other jobs running
+            traceback.print_exc()
+            job.status = "failed"
+            job.error = f"{type(e).__name__}: {e}"
+        job.finished_at = time.time()
+        print(f"Job {job.name} {job.status}")
+
+    def wait(self) -> bool:
+        # True if all jobs finished successfully
+        with self.lock:
+            futures = list(self.futures)
+        for future in futures:
+            future.result()
+        with self.lock:
+            return all(job.status == "finished" for job in self.jobs)
+
+    def status_page(self) -> str:
+        with self.lock:
+            jobs = list(self.jobs)
+
+        def when(t):
+            if t is None:
+                return ""
+            return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+
+        rows = []
+        for job in jobs:
+            documents = 0
+            if job.checkpoint is not None:
+                documents = len(job.checkpoint.documents)
+            rows.append(
+                f"<tr><td>{html.escape(job.name)}</td><td>{job.status}</td>"
+                f"<td>{when(job.queued_at)}</td><td>{when(job.started_at)}</td>"
+                f"<td>{when(job.finished_at)}</td><td>{documents}</td>"
+                f"<td>{html.escape(job.error or '')}</td></tr>"
+            )
+        counts = ", ".join(
+            f"{sum(job.status == status for job in jobs)} {status}"
+            for status in ["queued", "running", "finished", "failed"]
+        )
+        return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta http-equiv="refresh" content="5">
+<title>feishu-backup</title>
+</head>
+<body>
+<p>{counts}</p>
+<table border="1">
+<tr><th>Account</th><th>Status</th><th>Queued</th><th>Started</th><th>Finished</th><th>Documents</th><th>Error</th></tr>
+{"".join(rows)}
+</table>
+</body>
+</html>
+"""
@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import runpy
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, root)
+import mock_server
+
+# run backup.py and backup-calendar.py against the mock server of
+# mock_server.py and report documents and requests per second, peak rss
+# and bytes written of every scenario
+# every run is a fresh process with a fresh backup_path
+
+# script and mock server options of the standard scenarios, the other
+# mock server options apply to all of them
+scenarios = {
+    "docs": ("backup.py", {"docs": 10000}),
+    "docx": ("backup.py", {"docs": 0, "docx_blocks": 100000}),
+    "calendar": ("backup-calendar.py", {"events": 50000}),
+}
+
+# counts of a scenario scaled by --scale
+scaled = ["docs", "docx_blocks", "wiki_nodes", "events"]
+
+
+def child(script, backup_path, state_path):
+    # run script as __main__ with a secret.py of the mock account, a file and
+    # not a module object as the render processes import the script again
+    with open(f"{state_path}/secret.py", "w", encoding="utf-8") as f:
+        f.write('app_id = "cli_mock"\napp_secret = "mock"\n')
+        f.write(f"backup_path = {backup_path!r}\n")
+    sys.path[:0] = [state_path, root]
+    runpy.run_path(os.path.join(root, script), run_name="__main__")
+
+
+def login(url, state_path):
+    # cache a user token so the script can run with --headless
+    import auth
+    import feishu
+
+    feishu.configure(base=url)
+    auth.state_path = state_path
+    token = auth.UserToken(auth.token_path(), "cli_mock", "mock")
+    token.login("mock")
+
+
+def written(folder):
+    total = 0
+    for path, _, files in os.walk(folder):
+        for name in files:
+            total += os.path.getsize(os.path.join(path, name))
+    return total
+
+
+def documents(metrics_path):
+    with open(metrics_path, "r", encoding="utf-8") as f:
+        return sum(json.load(f)["documents"].values())
+
+
+def run(name, args, extra):
+    script, options = scenarios[name]
+    options = {
+        key: int(value * args.scale) if key in scaled else value
+        for key, value in options.items()
+    }
+    tree = argparse.Namespace(**{**vars(args), **options})
+    server = mock_server.create(tree)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    with tempfile.TemporaryDirectory(
+        dir=args.tmp
+    ) as backup_path, tempfile.TemporaryDirectory() as state_path:
+        login(server.url(), state_path)
+        server.requests = 0
+        command = [
+            sys.executable,
+            os.path.abspath(__file__),
+            "--child",
+            script,
+            backup_path,
+            state_path,
+            "--headless",
+            "--state-path",
+            state_path,
+            "--base-url",
+            server.url(),
+            *extra,
+        ]
+        start = time.monotonic()
+        proc = subprocess.Popen(
+            command, stdout=subprocess.DEVNULL if not args.verbose else None
+        )
+        # rusage of this child only, ru_maxrss is in KiB on linux
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        elapsed = time.monotonic() - start
+        server.shutdown()
+        server.server_close()
+        if proc.returncode != 0:
+            print(f"{name}: failed with exit code {proc.returncode}")
+            return
+
+        metrics_path = f"{backup_path}/metrics.json"
+        if script == "backup-calendar.py":
+            metrics_path = f"{backup_path}/calendar/metrics.json"
+        count = documents(metrics_path)
+        print(
+            f"{name:>10} {elapsed:8.1f}s {count / elapsed:10.1f} docs/s "
+            f"{server.requests / elapsed:10.1f} req/s {usage.ru_maxrss / 1024:8.1f}MB rss "
+            f"{written(backup_path) / 1e6:8.1f}MB written"
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        script, backup_path, state_path = sys.argv[2:5]
+        sys.argv = [script, *sys.argv[5:]]
+        child(script, backup_path, state_path)
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark backup.py and backup-calendar.py against a mock server",
+        epilog="arguments after -- are passed to the scripts, e.g. -- --engine async",
+    )
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        metavar="scenario",
+        help=f"any of {', '.join(scenarios)}, default all",
+    )
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="multiply the size of the scenarios"
+    )
+    parser.add_argument("--tmp", help="folder for the backups, default the system one")
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the output of the scripts"
+    )
+    mock_server.add_arguments(parser)
+    argv = sys.argv[1:]
+    extra = []
+    if "--" in argv:
+        extra = argv[argv.index("--") + 1 :]
+        argv = argv[: argv.index("--")]
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in scenarios:
+            parser.error(f"unknown scenario {name}")
+
+    for name in args.scenarios or scenarios:
+        run(name, args, extra)
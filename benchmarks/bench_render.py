@@ -0,0 +1,143 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from render import Dumper, DocxDumper
+
+# render synthetic documents of increasing size into a file
+# time per block should stay flat if rendering is linear
+
+
+def text_run(text):
+    return {"type": "textRun", "textRun": {"text": text}}
+
+
+def make_doc(blocks):
+    body = []
+    for i in range(blocks):
+        if i % 50 == 0:
+            body.append(
+                {
+                    "type": "table",
+                    "table": {
+                        "tableRows": [
+                            {
+                                "tableCells": [
+                                    {"body": {"blocks": [text_run(f"cell {i} {j}")]}}
+                                    for j in range(4)
+                                ]
+                            }
+                            for _ in range(4)
+                        ]
+                    },
+                }
+            )
+        else:
+            body.append(
+                {
+                    "type": "paragraph",
+                    "paragraph": {
+                        "elements": [text_run(f"paragraph {i} "), text_run("text")],
+                        "style": {"list": {"type": "bullet"}},
+                    },
+                }
+            )
+    return {"title": {"elements": [text_run("title")]}, "body": {"blocks": body}}
+
+
+def make_docx(blocks):
+    # flat blocks under the page, every 10th one has a nested child and
+    # every 100th one is a 2x2 table
+    page = {
+        "block_id": "page",
+        "block_type": 1,
+        "children": [],
+        "page": {"elements": [{"text_run": {"content": "title"}}]},
+    }
+    items = [page]
+
+    def add(block_id, parent, block_type, key):
+        block = {
+            "block_id": block_id,
+            "parent_id": parent["block_id"],
+            "block_type": block_type,
+            "children": [],
+            key: {"elements": [{"text_run": {"content": f"block {block_id} text"}}]},
+        }
+        parent["children"].append(block_id)
+        items.append(block)
+        return block
+
+    kinds = [(2, "text"), (3, "heading1"), (12, "bullet"), (13, "ordered")]
+    for i in range(blocks):
+        if i % 100 == 99:
+            table = {
+                "block_id": f"b{i}",
+                "parent_id": "page",
+                "block_type": 31,
+                "table": {
+                    "cells": [f"b{i}c{j}" for j in range(4)],
+                    "property": {"row_size": 2, "column_size": 2},
+                },
+                "children": [],
+            }
+            page["children"].append(table["block_id"])
+            items.append(table)
+            for j in range(4):
+                cell = {
+                    "block_id": f"b{i}c{j}",
+                    "parent_id": table["block_id"],
+                    "block_type": 32,
+                    "table_cell": {},
+                    "children": [],
+                }
+                table["children"].append(cell["block_id"])
+                items.append(cell)
+                add(f"b{i}c{j}t", cell, 2, "text")
+            continue
+        block_type, key = kinds[i % len(kinds)]
+        block = add(f"b{i}", page, block_type, key)
+        if i % 10 == 2:
+            add(f"b{i}n", block, 12, "bullet")
+    return items
+
+
+def bench(name, make, render, sizes):
+    print(f"{name}:")
+    for size in sizes:
+        content = make(size)
+        with tempfile.TemporaryFile("w") as f:
+            start = time.perf_counter()
+            render(f, content)
+            f.flush()
+            elapsed = time.perf_counter() - start
+            written = f.tell()
+        print(
+            f"  {size:>8} blocks {elapsed:8.3f}s {elapsed / size * 1e6:8.2f}us/block {written / 1e6:8.2f}MB"
+        )
+
+
+def render_doc(f, content):
+    Dumper(f).dump(content)
+
+
+def render_docx(f, content):
+    DocxDumper(f).dump(content)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark markdown rendering")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="number of blocks of the synthetic documents",
+    )
+    args = parser.parse_args()
+
+    bench("doc", make_doc, render_doc, args.sizes)
+    bench("docx", make_docx, render_docx, args.sizes)
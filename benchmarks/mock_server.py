@@ -0,0 +1,516 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+# local stand-in for the feishu open api, serving a synthetic tree
+# point the scripts at it with --base-url http://127.0.0.1:<port>
+#
+# root folder: `docs` small documents (doc, docx and sheet in turn), in
+# subfolders of `folder_size`, plus one docx of `docx_blocks` blocks
+# wiki: one space with `wiki_nodes` docx nodes
+# calendar: `calendars` calendars with `events` events in total
+
+
+class Tree:
+    def __init__(
+        self,
+        docs=100,
+        folder_size=100,
+        docx_blocks=0,
+        wiki_nodes=0,
+        images=0,
+        image_size=16 * 1024,
+        sheet_rows=20,
+        calendars=1,
+        events=0,
+    ) -> None:
+        self.docs = docs
+        self.folder_size = folder_size
+        self.docx_blocks = docx_blocks
+        self.wiki_nodes = wiki_nodes
+        # distinct images, document i shows image i % images
+        self.images = images
+        self.image_size = image_size
+        self.sheet_rows = sheet_rows
+        self.calendars = calendars
+        self.events = events
+
+    def folders(self):
+        return (self.docs + self.folder_size - 1) // self.folder_size
+
+    def folder_files(self, index):
+        start = index * self.folder_size
+        for i in range(start, min(start + self.folder_size, self.docs)):
+            obj_type = ["doc", "docx", "sheet"][i % 3]
+            yield {"type": obj_type, "name": f"doc {i}", "token": f"{obj_type}{i}"}
+
+    def root_files(self):
+        for index in range(self.folders()):
+            yield {"type": "folder", "name": f"folder {index}", "token": f"fld{index}"}
+        if self.docx_blocks > 0:
+            yield {"type": "docx", "name": "big", "token": "docxbig"}
+
+    def image(self, i):
+        if self.images == 0:
+            return None
+        return f"img{i % self.images}"
+
+    def doc_content(self, i):
+        blocks = [
+            {
+                "type": "paragraph",
+                "paragraph": {
+                    "elements": [
+                        {"type": "textRun", "textRun": {"text": f"paragraph {j}"}}
+                    ]
+                },
+            }
+            for j in range(10)
+        ]
+        if self.image(i) is not None:
+            blocks.append(
+                {
+                    "type": "gallery",
+                    "gallery": {"imageList": [{"fileToken": self.image(i)}]},
+                }
+            )
+        return json.dumps(
+            {
+                "title": {
+                    "elements": [{"type": "textRun", "textRun": {"text": f"doc {i}"}}]
+                },
+                "body": {"blocks": blocks},
+            }
+        )
+
+    def docx_blocks_of(self, token):
+        # the page block first, then its children
+        if token == "docxbig":
+            count, image = self.docx_blocks, None
+        elif token.startswith("wiki"):
+            count, image = 10, None
+        else:
+            i = int(token[len("docx") :])
+            count, image = 10, self.image(i)
+        return count + 1 + (image is not None), image
+
+    def docx_block(self, token, index, image):
+        if index == 0:
+            count, _ = self.docx_blocks_of(token)
+            return {
+                "block_id": token,
+                "block_type": 1,
+                "children": [f"{token}_{i}" for i in range(1, count)],
+                "page": {"elements": [{"text_run": {"content": token}}]},
+            }
+        if image is not None and index == 1:
+            return {
+                "block_id": f"{token}_{index}",
+                "parent_id": token,
+                "block_type": 27,
+                "image": {"token": image},
+            }
+        block_type, key = [(2, "text"), (3, "heading1"), (12, "bullet")][index % 3]
+        return {
+            "block_id": f"{token}_{index}",
+            "parent_id": token,
+            "block_type": block_type,
+            key: {"elements": [{"text_run": {"content": f"block {index}"}}]},
+        }
+
+    def event(self, calendar, index):
+        event = {
+            "event_id": f"{calendar}_e{index}",
+            "status": "confirmed",
+            "summary": f"event {index}",
+            "create_time": "1600000000",
+        }
+        if index % 2 == 0:
+            start = 1600000000 + index * 3600
+            event["start_time"] = {"timestamp": str(start), "timezone": "Asia/Shanghai"}
+            event["end_time"] = {
+                "timestamp": str(start + 1800),
+                "timezone": "Asia/Shanghai",
+            }
+        else:
+            event["start_time"] = {"date": "2020-09-14"}
+            event["end_time"] = {"date": "2020-09-15"}
+        return event
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self, address, tree, latency=0.0, page_size=None, rate_limit=0.0, seed=0
+    ) -> None:
+        super().__init__(address, Handler)
+        self.tree = tree
+        # seconds added to every response
+        self.latency = latency
+        # max items per page, below what the client asks for to force paging
+        self.page_size = page_size
+        # share of requests answered with a rate limit error
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def limit(self, requested):
+        if self.page_size is None:
+            return requested
+        return min(requested, self.page_size)
+
+
+def page(items, total, query, page_size, token_field="page_token"):
+    # items(start, end) of a list of total items, page_token is the offset
+    start = int(query.get("page_token", ["0"])[0])
+    end = min(start + page_size, total)
+    data = {"items": list(items(start, end)), "has_more": end < total}
+    if end < total:
+        data[token_field] = str(end)
+    return data
+
+
+class Handler(BaseHTTPRequestHandler):
+    # keep-alive like the real api
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes, don't wait for delayed acks
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body, content_type="application/json", headers={}):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def ok(self, data=None, **fields):
+        body = {"code": 0, "msg": "success", **fields}
+        if data is not None:
+            body["data"] = data
+        self.send(200, json.dumps(body).encode("utf-8"))
+
+    def do_GET(self):
+        self.handle_api("GET")
+
+    def do_POST(self):
+        self.handle_api("POST")
+
+    def handle_api(self, method):
+        server = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length > 0 else {}
+        with server.lock:
+            server.requests += 1
+            limited = server.random.random() < server.rate_limit
+            if limited:
+                server.rate_limited += 1
+        if server.latency > 0:
+            time.sleep(server.latency)
+        if limited:
+            # https://open.feishu.cn/document/server-docs/api-call-guide/frequency-control
+            body = json.dumps(
+                {"code": 99991400, "msg": "request trigger frequency limit"}
+            )
+            self.send(429, body.encode("utf-8"), headers={"x-ogw-ratelimit-reset": "1"})
+            return
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path.removeprefix("/open-apis")
+        for pattern, handler in routes:
+            match = re.fullmatch(pattern, path)
+            if match is not None:
+                handler(self, server.tree, query, body, *match.groups())
+                return
+        self.send(404, json.dumps({"code": 404, "msg": f"no route {path}"}).encode())
+
+
+def app_token(handler, tree, query, body):
+    handler.ok(
+        app_access_token="mock-app-token",
+        tenant_access_token="mock-tenant-token",
+        expire=7200,
+    )
+
+
+def user_token(handler, tree, query, body):
+    handler.ok(
+        {
+            "access_token": "mock-user-token",
+            "refresh_token": "mock-refresh-token",
+            "expires_in": 7200,
+            "refresh_expires_in": 2592000,
+            "open_id": "ou_mock",
+            "name": "mock",
+        }
+    )
+
+
+def login_page(handler, tree, query, body):
+    # skip the login and go straight back to the callback
+    location = f'{query["redirect_uri"][0]}?code=mock&state={query["state"][0]}'
+    handler.send(302, b"", "text/plain", {"Location": location})
+
+
+def root_folder(handler, tree, query, body):
+    handler.ok({"token": "root", "id": "0"})
+
+
+def folder(handler, tree, query, body):
+    token = query["folder_token"][0]
+    if token == "root":
+        files = list(tree.root_files())
+    else:
+        files = list(tree.folder_files(int(token[len("fld") :])))
+    size = handler.server.limit(int(query.get("page_size", ["200"])[0]))
+    data = page(lambda start, end: files[start:end], len(files), query, size)
+    data["files"] = data.pop("items")
+    if data["has_more"]:
+        data["next_page_token"] = data.pop("page_token")
+    for file in data["files"]:
+        file["modified_time"] = "1600000000"
+    handler.ok(data)
+
+
+def batch_query(handler, tree, query, body):
+    metas = [
+        {
+            "doc_token": doc["doc_token"],
+            "doc_type": doc["doc_type"],
+            "latest_modify_time": "1600000000",
+        }
+        for doc in body["request_docs"]
+    ]
+    handler.ok({"metas": metas, "failed_list": []})
+
+
+def doc(handler, tree, query, body, token):
+    handler.ok({"content": tree.doc_content(int(token[len("doc") :])), "revision": 1})
+
+
+def docx(handler, tree, query, body, token):
+    count, image = tree.docx_blocks_of(token)
+    size = handler.server.limit(int(query.get("page_size", ["500"])[0]))
+    handler.ok(
+        page(
+            lambda start, end: (
+                tree.docx_block(token, i, image) for i in range(start, end)
+            ),
+            count,
+            query,
+            size,
+        )
+    )
+
+
+def metainfo(handler, tree, query, body, token):
+    sheet = {
+        "sheetId": "s1",
+        "title": "Sheet1",
+        "rowCount": tree.sheet_rows,
+        "columnCount": 5,
+    }
+    handler.ok({"spreadsheetToken": token, "sheets": [sheet]})
+
+
+def sheet_rows(cells):
+    # s1!A1:E20 -> rows of the range
+    match = re.fullmatch(r"\w+!A(\d+):[A-Z]+(\d+)", cells)
+    if match is None:
+        return []
+    start, end = int(match.group(1)), int(match.group(2))
+    return [
+        [f"r{row}c{column}" for column in range(5)] for row in range(start, end + 1)
+    ]
+
+
+def values_batch(handler, tree, query, body, token):
+    ranges = unquote(query["ranges"][0]).split(",")
+    handler.ok(
+        {
+            "valueRanges": [
+                {"range": cells, "values": sheet_rows(cells)} for cells in ranges
+            ]
+        }
+    )
+
+
+def values(handler, tree, query, body, token, sheet_id):
+    handler.ok(
+        {"valueRange": {"values": sheet_rows(f"{sheet_id}!A1:E{tree.sheet_rows}")}}
+    )
+
+
+def media(handler, tree, query, body, token):
+    data = (token.encode("utf-8") * tree.image_size)[: tree.image_size]
+    range = handler.headers.get("Range")
+    if range is not None:
+        start = int(range.removeprefix("bytes=").split("-")[0])
+        if start >= len(data):
+            handler.send(416, b"", "image/png")
+            return
+        handler.send(206, data[start:], "image/png")
+        return
+    handler.send(200, data, "image/png")
+
+
+def wiki_spaces(handler, tree, query, body):
+    items = []
+    if tree.wiki_nodes > 0:
+        items.append({"space_id": "space0", "name": "wiki"})
+    handler.ok({"items": items, "has_more": False})
+
+
+def wiki_nodes(handler, tree, query, body, space_id):
+    if "parent_node_token" in query:
+        handler.ok({"items": [], "has_more": False})
+        return
+
+    def node(i):
+        return {
+            "node_token": f"node{i}",
+            "obj_token": f"wiki{i}",
+            "obj_type": "docx",
+            "title": f"node {i}",
+            "has_child": False,
+            "obj_edit_time": "1600000000",
+        }
+
+    size = handler.server.limit(int(query.get("page_size", ["50"])[0]))
+    handler.ok(
+        page(
+            lambda start, end: map(node, range(start, end)),
+            tree.wiki_nodes,
+            query,
+            size,
+        )
+    )
+
+
+def calendars(handler, tree, query, body):
+    calendar_list = [
+        {"calendar_id": f"cal{i}", "summary": f"calendar {i}"}
+        for i in range(tree.calendars)
+    ]
+    handler.ok({"calendar_list": calendar_list, "has_more": False})
+
+
+def events(handler, tree, query, body, calendar_id):
+    if "sync_token" in query:
+        # nothing changed since the last run
+        handler.ok({"items": [], "has_more": False, "sync_token": "mock-sync-token"})
+        return
+    index = int(calendar_id[len("cal") :])
+    # the events are spread over the calendars
+    total = tree.events // tree.calendars + (index < tree.events % tree.calendars)
+    size = handler.server.limit(int(query.get("page_size", ["500"])[0]))
+    data = page(
+        lambda start, end: (tree.event(calendar_id, i) for i in range(start, end)),
+        total,
+        query,
+        size,
+    )
+    if not data["has_more"]:
+        data["sync_token"] = "mock-sync-token"
+    handler.ok(data)
+
+
+routes = [
+    (r"/auth/v3/app_access_token/internal", app_token),
+    (r"/authen/v1/(?:refresh_)?access_token", user_token),
+    (r"/authen/v1/index", login_page),
+    (r"/drive/explorer/v2/root_folder/meta", root_folder),
+    (r"/drive/v1/files", folder),
+    (r"/drive/v1/metas/batch_query", batch_query),
+    (r"/drive/v1/medias/(\w+)/download", media),
+    (r"/doc/v2/(\w+)/content", doc),
+    (r"/docx/v1/documents/(\w+)/blocks", docx),
+    (r"/sheets/v2/spreadsheets/(\w+)/metainfo", metainfo),
+    (r"/sheets/v2/spreadsheets/(\w+)/values_batch_get", values_batch),
+    (r"/sheets/v2/spreadsheets/(\w+)/values/(\w+)", values),
+    (r"/wiki/v2/spaces", wiki_spaces),
+    (r"/wiki/v2/spaces/(\w+)/nodes", wiki_nodes),
+    (r"/calendar/v4/calendars", calendars),
+    (r"/calendar/v4/calendars/(\w+)/events", events),
+]
+
+
+def add_arguments(parser):
+    # tree and fault options, shared with bench_backup.py
+    parser.add_argument("--docs", type=int, default=100, help="small documents")
+    parser.add_argument("--folder-size", type=int, default=100)
+    parser.add_argument(
+        "--docx-blocks", type=int, default=0, help="blocks of one big docx"
+    )
+    parser.add_argument("--wiki-nodes", type=int, default=0)
+    parser.add_argument("--images", type=int, default=0, help="distinct images")
+    parser.add_argument("--image-size", type=int, default=16 * 1024)
+    parser.add_argument("--sheet-rows", type=int, default=20)
+    parser.add_argument("--calendars", type=int, default=1)
+    parser.add_argument("--events", type=int, default=0)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds per request"
+    )
+    parser.add_argument("--page-size", type=int, help="max items per page")
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0.0,
+        help="share of requests answered with 429",
+    )
+
+
+def tree_of(args):
+    return Tree(
+        docs=args.docs,
+        folder_size=args.folder_size,
+        docx_blocks=args.docx_blocks,
+        wiki_nodes=args.wiki_nodes,
+        images=args.images,
+        image_size=args.image_size,
+        sheet_rows=args.sheet_rows,
+        calendars=args.calendars,
+        events=args.events,
+    )
+
+
+def create(args, port=0):
+    return Server(
+        ("127.0.0.1", port),
+        tree_of(args),
+        latency=args.latency,
+        page_size=args.page_size,
+        rate_limit=args.rate_limit,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock feishu api server")
+    parser.add_argument("--port", type=int, default=8080)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = create(args, args.port)
+    print(f"Serving on {server.url()}, use --base-url {server.url()}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,102 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# thread safe lru cache with size bound and hit/miss counters
+# concurrent lookups of the same missing key share one load
+
+
+class LRUCache:
+    def __init__(self, max_size, sizeof=lambda value: 1) -> None:
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.lock = threading.Lock()
+        # key -> (value, size), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        # key -> Future of a load in progress
+        self.loading = {}
+        # --engine async: key -> Task of a load in progress
+        self.tasks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        owner = False
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            future = self.loading.get(key)
+            if future is not None:
+                # someone else is loading it right now
+                self.hits += 1
+            else:
+                self.misses += 1
+                future = Future()
+                self.loading[key] = future
+                owner = True
+        if not owner:
+            return future.result()
+
+        try:
+            value = load()
+        except BaseException as e:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            del self.loading[key]
+            self.put(key, value)
+        future.set_result(value)
+        return value
+
+    async def get_async(self, key, load):
+        # get for --engine async, load is a coroutine function
+        # the event loops of a batch use separate keys
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            task = self.tasks.get(key)
+            if task is not None:
+                # another coroutine is loading it right now
+                self.hits += 1
+            else:
+                self.misses += 1
+                task = asyncio.ensure_future(self.load_async(key, load))
+                self.tasks[key] = task
+        # a cancelled caller does not cancel a load others wait for
+        return await asyncio.shield(task)
+
+    async def load_async(self, key, load):
+        try:
+            value = await load()
+        except BaseException:
+            with self.lock:
+                del self.tasks[key]
+            raise
+
+        with self.lock:
+            del self.tasks[key]
+            self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        # called with lock held
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= evicted
+
+    def stats(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses, {len(self.entries)} entries"
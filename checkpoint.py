@@ -0,0 +1,104 @@
+import json
+import os
+import threading
+import time
+
+# crawl progress of a run, saved regularly so an interrupted run can resume
+# listings: cached folder/node listings, so finished folders are not listed again
+# documents: output paths that are completely written
+# images: image tokens whose download has started but not finished
+# calendars: calendar_id -> {"params", "page_token"} or {"done": true}
+
+
+class Checkpoint:
+    def __init__(self, file_path, resume=False, interval=30) -> None:
+        self.file_path = file_path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last_save = time.monotonic()
+        self.listings = {}
+        self.documents = set()
+        self.images = set()
+        self.calendars = {}
+        # manifest.Manifest saved with every checkpoint, so documents that
+        # --resume skips as finished are in it after a hard kill
+        self.manifest = None
+        if resume and os.path.exists(file_path):
+            print(f"Resuming from {file_path}")
+            with open(file_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            self.listings = state["listings"]
+            self.documents = set(state["documents"])
+            self.images = set(state["images"])
+            self.calendars = state["calendars"]
+        elif os.path.exists(file_path):
+            print(f"Ignoring checkpoint {file_path}, use --resume to continue it")
+
+    def listing(self, key):
+        with self.lock:
+            return self.listings.get(key)
+
+    def set_listing(self, key, items):
+        with self.lock:
+            self.listings[key] = items
+        self.save_if_due()
+
+    def document_done(self, path) -> bool:
+        with self.lock:
+            return path in self.documents
+
+    def finish_document(self, path):
+        with self.lock:
+            self.documents.add(path)
+        self.save_if_due()
+
+    def pending_images(self):
+        with self.lock:
+            return list(self.images)
+
+    def start_image(self, token):
+        with self.lock:
+            self.images.add(token)
+
+    def finish_image(self, token):
+        with self.lock:
+            self.images.discard(token)
+
+    def calendar(self, calendar_id):
+        with self.lock:
+            return self.calendars.get(calendar_id)
+
+    def set_calendar(self, calendar_id, state):
+        with self.lock:
+            self.calendars[calendar_id] = state
+        self.save_if_due()
+
+    def save_if_due(self):
+        if time.monotonic() - self.last_save >= self.interval:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            self.last_save = time.monotonic()
+            # first and under the lock: finish_document follows the manifest
+            # update, every document saved as finished is in the manifest
+            if self.manifest is not None:
+                self.manifest.save()
+            data = json.dumps(
+                {
+                    "listings": self.listings,
+                    "documents": sorted(self.documents),
+                    "images": sorted(self.images),
+                    "calendars": self.calendars,
+                },
+                ensure_ascii=False,
+            )
+            tmp_path = f"{self.file_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, self.file_path)
+
+    def remove(self):
+        # the run finished, nothing to resume
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
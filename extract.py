@@ -0,0 +1,58 @@
+import argparse
+import os
+import sqlite3
+import tarfile
+from output import deleted_header
+
+# unpack a backup.sqlite or backup.tar.zst archive into a folder
+
+
+def extract_sqlite(file_path, dest):
+    db = sqlite3.connect(file_path)
+    # the latest row of every path wins
+    rows = db.execute(
+        """
+        SELECT files.path, blobs.data FROM files
+        JOIN (SELECT path, MAX(id) AS id FROM files GROUP BY path) latest
+        ON files.id = latest.id
+        JOIN blobs ON blobs.hash = files.hash
+        """
+    )
+    for path, data in rows:
+        file_path = f"{dest}{path}"
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as file:
+            file.write(data)
+    db.close()
+
+
+def extract_tar(file_path, dest):
+    import zstandard
+
+    with open(file_path, "rb") as file:
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            file, read_across_frames=True
+        )
+        # one tar stream per run, later members replace earlier ones
+        with tarfile.open(fileobj=reader, mode="r|", ignore_zeros=True) as tar:
+            for info in tar:
+                file_path = f"{dest}/{info.name}"
+                if deleted_header in info.pax_headers:
+                    if os.path.exists(file_path):
+                        os.remove(file_path)
+                    continue
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, "wb") as out:
+                    out.write(tar.extractfile(info).read())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract a feishu-backup archive")
+    parser.add_argument("archive", help="backup.sqlite or backup.tar.zst")
+    parser.add_argument("dest", help="folder to extract into")
+    args = parser.parse_args()
+
+    if args.archive.endswith(".sqlite"):
+        extract_sqlite(args.archive, args.dest)
+    else:
+        extract_tar(args.archive, args.dest)
@@ -0,0 +1,191 @@
+import threading
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import throttle
+import metrics
+
+# shared http client for backup.py and backup-calendar.py
+# one keep-alive connection pool is reused by all requests
+
+# the api host, every url is written against it and mapped by resolve()
+api_host = "https://open.feishu.cn"
+# where requests are sent, e.g. the mock server of benchmarks/
+base_url = api_host
+
+# max connections kept alive to the api host
+pool_size = 16
+
+# (connect, read) timeout in seconds
+timeout = (10, 60)
+
+# attempts of a rate limited request before giving up
+max_attempts = 10
+
+# retry policies, the longest matching url prefix wins
+# retry logic from https://gist.github.com/benjiao/28dc36bd87121b3273e0b3e079a8e8d8
+retries = {
+    "https://": Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504],
+    ),
+    # token endpoints are POST, which urllib3 does not retry by default
+    "https://open.feishu.cn/open-apis/auth/": Retry(
+        total=3,
+        backoff_factor=1,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=None,
+    ),
+    "https://open.feishu.cn/open-apis/authen/": Retry(
+        total=3,
+        backoff_factor=1,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=None,
+    ),
+    # media downloads are large and the cdn fails more often
+    "https://open.feishu.cn/open-apis/drive/v1/medias/": Retry(
+        total=8,
+        backoff_factor=1,
+        status_forcelist=[500, 502, 503, 504],
+    ),
+}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def configure(size=None, base=None):
+    # must be called before the first request to take effect
+    global pool_size, base_url, _session
+    if size is not None:
+        pool_size = size
+    if base is not None:
+        base_url = base.rstrip("/")
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                s = requests.Session()
+                # a plain http base_url gets the default policy
+                prefixes = {"http://": retries["https://"]}
+                prefixes.update({resolve(p): retry for p, retry in retries.items()})
+                for prefix, retry in prefixes.items():
+                    s.mount(
+                        prefix,
+                        HTTPAdapter(
+                            pool_connections=1,
+                            pool_maxsize=pool_size,
+                            max_retries=retry,
+                        ),
+                    )
+                _session = s
+    return _session
+
+
+def resolve(url):
+    # where a request for url is sent
+    if base_url != api_host and url.startswith(api_host):
+        return base_url + url[len(api_host) :]
+    return url
+
+
+def retry_policy(url) -> Retry:
+    # the policy requests picks for url: the longest matching prefix
+    prefix = max((p for p in retries if url.startswith(p)), key=len)
+    return retries[prefix]
+
+
+def auth_headers(access_token):
+    if access_token is None:
+        return {}
+    if callable(access_token):
+        # auth.UserToken, refreshed when it is about to expire
+        access_token = access_token()
+    return {"Authorization": f"Bearer {access_token}"}
+
+
+def rate_limited(resp):
+    if resp.status_code == 429:
+        return True
+    if resp.headers.get("Content-Type", "").startswith("application/json"):
+        try:
+            return resp.json().get("code") in throttle.rate_limit_codes
+        except ValueError:
+            return False
+    return False
+
+
+def request(method, url, access_token, headers=None, **kwargs):
+    # wait for the throttle of the endpoint family, retry while rate limited
+    t = throttle.throttle(url)
+    for attempt in range(max_attempts):
+        t.acquire()
+        # built for every attempt, the backoff can outlast the access token
+        attempt_headers = {**auth_headers(access_token), **(headers or {})}
+        start = time.monotonic()
+        resp = session().request(
+            method, resolve(url), headers=attempt_headers, timeout=timeout, **kwargs
+        )
+        # streamed bodies are counted by the reader
+        size = None if kwargs.get("stream") else len(resp.content)
+        if not rate_limited(resp):
+            metrics.request(t.name, resp.status_code, time.monotonic() - start, size)
+            t.success()
+            return resp
+
+        metrics.request(t.name, "rate_limited", time.monotonic() - start, size)
+
+        wait = throttle.backoff(attempt, throttle.retry_after(resp))
+        print(f"Rate limited on {t.name}, retrying in {wait:.1f}s")
+        resp.close()
+        t.rate_limited(wait)
+
+    print(f"Request to {url} is still rate limited after {max_attempts} attempts")
+    sys.exit(1)
+
+
+def get(url, access_token):
+    resp = request("GET", url, access_token)
+    json = resp.json()
+    if json["code"] != 0:
+        print(f"Request to {url} failed with: {json}")
+        sys.exit(1)
+    return json["data"]
+
+
+def pages(url, access_token, token_field="page_token"):
+    # iterate over the pages of a paged list api
+    # the next page is fetched in the background while the caller handles
+    # the current one, so at most two pages are held in memory
+    sep = "&" if "?" in url else "?"
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(get, url, access_token)
+        while future is not None:
+            data = future.result()
+            if data.get("has_more"):
+                next_url = f"{url}{sep}page_token={data[token_field]}"
+                future = executor.submit(get, next_url, access_token)
+            else:
+                future = None
+            yield data
+
+
+def post(url, access_token=None, json=None):
+    resp = request("POST", url, access_token, json=json)
+    return resp.json()
+
+
+def download(url, access_token, headers=None):
+    # caller reads the body, use as a context manager to release the connection
+    return request("GET", url, access_token, headers=headers, stream=True)
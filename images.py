@@ -0,0 +1,143 @@
+import asyncio
+import os
+import shutil
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import feishu
+import metrics
+
+# content store for images: every token is downloaded once into root
+# and hard linked into each document folder that references it
+
+
+def link_file(src, dest):
+    if os.path.exists(dest):
+        return
+    try:
+        os.link(src, dest)
+    except OSError:
+        # different file system or no hard link support
+        shutil.copyfile(src, dest)
+
+
+class ImageStore:
+    def __init__(self, root, jobs=8, chunk_size=64 * 1024) -> None:
+        self.root = root
+        self.jobs = jobs
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.lock = threading.Lock()
+        # token -> Future of the download, shared by concurrent documents
+        self.futures = {}
+        # --engine async: token -> Task of the download
+        self.tasks = {}
+        self.semaphore = None
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, token):
+        return f"{self.root}/{token}.png"
+
+    def fetch(self, token, access_token) -> Future:
+        started = False
+        with self.lock:
+            future = self.futures.get(token)
+            if future is None:
+                if os.path.exists(self.path(token)):
+                    future = Future()
+                    future.set_result(self.path(token))
+                else:
+                    metrics.queue("images", 1)
+                    future = self.executor.submit(self.download, token, access_token)
+                    started = True
+                self.futures[token] = future
+        # outside the lock, the callback runs right away if it is done already
+        if started:
+            future.add_done_callback(lambda f: self._done(token, f))
+        return future
+
+    def _done(self, token, future):
+        metrics.queue("images", -1)
+        # allow a later document to retry a failed download
+        if future.exception() is not None:
+            with self.lock:
+                if self.futures.get(token) is future:
+                    del self.futures[token]
+
+    def download_url(self, token):
+        # https://open.feishu.cn/document/server-docs/docs/drive-v1/media/download
+        return f"https://open.feishu.cn/open-apis/drive/v1/medias/{token}/download"
+
+    def resume_headers(self, part_path):
+        # resume an interrupted download
+        headers = {}
+        if os.path.exists(part_path):
+            headers["Range"] = f"bytes={os.path.getsize(part_path)}-"
+        return headers
+
+    def download(self, token, access_token):
+        url = self.download_url(token)
+        file_path = self.path(token)
+        part_path = f"{file_path}.part"
+        headers = self.resume_headers(part_path)
+
+        print(f"Downloading image {token}")
+        with feishu.download(url, access_token, headers=headers) as resp:
+            if resp.status_code == 416:
+                # the part file is already complete
+                pass
+            else:
+                resp.raise_for_status()
+                mode = "ab" if resp.status_code == 206 else "wb"
+                with open(part_path, mode) as file:
+                    for chunk in resp.iter_content(self.chunk_size):
+                        file.write(chunk)
+                        metrics.add_bytes("media", len(chunk))
+        os.replace(part_path, file_path)
+        return file_path
+
+    async def fetch_async(self, client, token, access_token):
+        # the same store for --engine async, downloads are coroutines
+        task = self.tasks.get(token)
+        if task is None:
+            if os.path.exists(self.path(token)):
+                return self.path(token)
+            task = asyncio.create_task(self.download_async(client, token, access_token))
+            self.tasks[token] = task
+        try:
+            # a cancelled document does not cancel a download others wait for
+            return await asyncio.shield(task)
+        except Exception:
+            # allow a later document to retry a failed download
+            if self.tasks.get(token) is task and task.done():
+                del self.tasks[token]
+            raise
+
+    async def download_async(self, client, token, access_token):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.jobs)
+        async with self.semaphore:
+            url = self.download_url(token)
+            file_path = self.path(token)
+            part_path = f"{file_path}.part"
+            headers = self.resume_headers(part_path)
+
+            print(f"Downloading image {token}")
+            async with client.download(url, access_token, headers=headers) as resp:
+                if resp.status == 416:
+                    # the part file is already complete
+                    pass
+                else:
+                    resp.raise_for_status()
+                    mode = "ab" if resp.status == 206 else "wb"
+                    with open(part_path, mode) as file:
+                        async for chunk in resp.content.iter_chunked(self.chunk_size):
+                            file.write(chunk)
+                            metrics.add_bytes("media", len(chunk))
+            os.replace(part_path, file_path)
+            return file_path
+
+    def link(self, token, dest):
+        link_file(self.path(token), dest)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
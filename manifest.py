@@ -0,0 +1,68 @@
+import json
+import os
+import threading
+
+# persistent index of backed up files, keyed by file token
+# {token: {"type": ..., "revision": ..., "path": ..., "links": [...]}}
+# path is relative to the backup root, e.g. "/folder/doc.md"
+# links are other locations of the document with a pointer to path
+
+
+class Manifest:
+    def __init__(self, file_path, full=False) -> None:
+        self.file_path = file_path
+        # full refresh: ignore recorded revisions but still record new ones
+        self.full = full
+        self.lock = threading.Lock()
+        # saved by the checkpoint during a run and at the end
+        self.save_lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(file_path):
+            with open(file_path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def unchanged(self, token, revision, path) -> bool:
+        if self.full or revision is None:
+            return False
+        with self.lock:
+            entry = self.entries.get(token)
+        if entry is None:
+            return False
+        return entry["revision"] == revision and entry["path"] == path
+
+    def update(self, token, obj_type, revision, path):
+        with self.lock:
+            links = self.entries.get(token, {}).get("links")
+            self.entries[token] = {
+                "type": obj_type,
+                "revision": revision,
+                "path": path,
+            }
+            if links is not None:
+                self.entries[token]["links"] = links
+
+    def paths(self):
+        with self.lock:
+            return {token: entry["path"] for token, entry in self.entries.items()}
+
+    def set_links(self, links):
+        # token -> other locations, see registry.py
+        with self.lock:
+            for token, locations in links.items():
+                entry = self.entries.get(token)
+                if entry is None:
+                    continue
+                if len(locations) > 0:
+                    entry["links"] = locations
+                else:
+                    entry.pop("links", None)
+
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                data = json.dumps(self.entries, ensure_ascii=False, indent=1)
+            # write to a temporary file first so a crash never truncates the index
+            tmp_path = f"{self.file_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, self.file_path)
@@ -0,0 +1,108 @@
+import sys
+import threading
+import feishu
+
+# metadata stage between the crawl and the downloads: documents found in
+# listings are collected and their latest modify time is looked up in batches
+# https://open.feishu.cn/document/server-docs/docs/drive-v1/file/batch_query
+
+# max documents per batch_query request
+batch_size = 200
+
+batch_query_url = "https://open.feishu.cn/open-apis/drive/v1/metas/batch_query"
+
+
+def batch_query_body(docs):
+    return {
+        "request_docs": [
+            {"doc_token": doc["token"], "doc_type": doc["obj_type"]} for doc in docs
+        ]
+    }
+
+
+def apply_metas(docs, resp):
+    # update the revisions of docs from a batch_query response
+    if resp.get("code") != 0:
+        print(f"Batch query of metas failed with: {resp}")
+        sys.exit(1)
+    metas = {meta["doc_token"]: meta for meta in resp["data"].get("metas") or []}
+    for doc in docs:
+        meta = metas.get(doc["token"])
+        # the listing time of a shortcut or a wiki node is not the time
+        # the document changed; keep it for documents the query failed on
+        if meta is not None and meta.get("latest_modify_time"):
+            doc["revision"] = meta["latest_modify_time"]
+
+
+def new_doc(path, name, obj_type, token, revision):
+    return {
+        "path": path,
+        "name": name,
+        "obj_type": obj_type,
+        "token": token,
+        "revision": revision,
+    }
+
+
+class MetaStage:
+    def __init__(self, handle, access_token) -> None:
+        # handle(path, name, obj_type, token, revision) is called for every
+        # document once its metadata is known
+        self.handle = handle
+        self.access_token = access_token
+        self.lock = threading.Lock()
+        self.pending = []
+        self.calls = 0
+
+    def add(self, path, name, obj_type, token, revision):
+        doc = new_doc(path, name, obj_type, token, revision)
+        with self.lock:
+            self.pending.append(doc)
+            if len(self.pending) < batch_size:
+                return
+            docs = self.pending
+            self.pending = []
+        self.query(docs)
+
+    def flush(self):
+        with self.lock:
+            docs = self.pending
+            self.pending = []
+        if len(docs) > 0:
+            self.query(docs)
+
+    def query(self, docs):
+        resp = feishu.post(batch_query_url, self.access_token, batch_query_body(docs))
+        apply_metas(docs, resp)
+        with self.lock:
+            self.calls += 1
+        for doc in docs:
+            self.handle(**doc)
+
+
+class AsyncMetaStage:
+    # MetaStage for --engine async, handle is a coroutine function
+    def __init__(self, handle, client, access_token) -> None:
+        self.handle = handle
+        self.client = client
+        self.access_token = access_token
+        self.pending = []
+        self.calls = 0
+
+    async def add(self, path, name, obj_type, token, revision):
+        self.pending.append(new_doc(path, name, obj_type, token, revision))
+        if len(self.pending) >= batch_size:
+            await self.flush()
+
+    async def flush(self):
+        docs = self.pending
+        self.pending = []
+        if len(docs) == 0:
+            return
+        resp = await self.client.post(
+            batch_query_url, self.access_token, batch_query_body(docs)
+        )
+        apply_metas(docs, resp)
+        self.calls += 1
+        for doc in docs:
+            await self.handle(**doc)
@@ -0,0 +1,218 @@
+import bisect
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+
+# run metrics of the process: http requests per endpoint family (see
+# throttle.family), bytes downloaded, render time per document type,
+# queue depths and documents per second
+# written as json and as a prometheus textfile at the end of a run
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+
+# histogram buckets in seconds
+buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+class Histogram:
+    def __init__(self) -> None:
+        # counts[i] observations <= buckets[i], the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_json(self):
+        return {
+            "buckets": dict(zip([*map(str, buckets), "+Inf"], self.cumulative())),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+    def cumulative(self):
+        total = 0
+        result = []
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+
+_lock = threading.Lock()
+_start = time.monotonic()
+# family -> {status: count}
+_requests = {}
+# family -> Histogram
+_latency = {}
+# family -> bytes
+_bytes = {}
+# document type -> Histogram
+_render = {}
+# document type -> count
+_documents = {}
+# queue name -> [current, max]
+_queues = {}
+
+
+def start():
+    # documents per second are counted from here
+    global _start
+    with _lock:
+        _start = time.monotonic()
+
+
+def request(family, status, seconds, size):
+    # size is None for streamed responses, see add_bytes
+    with _lock:
+        statuses = _requests.setdefault(family, {})
+        statuses[status] = statuses.get(status, 0) + 1
+        _latency.setdefault(family, Histogram()).observe(seconds)
+        if size is not None:
+            _bytes[family] = _bytes.get(family, 0) + size
+
+
+def add_bytes(family, size):
+    with _lock:
+        _bytes[family] = _bytes.get(family, 0) + size
+
+
+def render(obj_type, seconds):
+    with _lock:
+        _render.setdefault(obj_type, Histogram()).observe(seconds)
+
+
+def document(obj_type):
+    with _lock:
+        _documents[obj_type] = _documents.get(obj_type, 0) + 1
+
+
+def queue(name, delta):
+    # track the depth of a queue, called with +1 and -1
+    with _lock:
+        depth = _queues.setdefault(name, [0, 0])
+        depth[0] += delta
+        depth[1] = max(depth[1], depth[0])
+
+
+def to_json():
+    with _lock:
+        elapsed = time.monotonic() - _start
+        documents = sum(_documents.values())
+        return {
+            "elapsed": elapsed,
+            "requests": {
+                family: {
+                    "status": {str(k): v for k, v in statuses.items()},
+                    "latency": _latency[family].to_json(),
+                    "bytes": _bytes.get(family, 0),
+                }
+                for family, statuses in sorted(_requests.items())
+            },
+            "render": {k: v.to_json() for k, v in sorted(_render.items())},
+            "documents": dict(sorted(_documents.items())),
+            "documents_per_second": documents / elapsed if elapsed > 0 else 0,
+            "queues": {k: {"max": v[1]} for k, v in sorted(_queues.items())},
+        }
+
+
+def to_prometheus():
+    data = to_json()
+    lines = []
+
+    def metric(name, kind, help):
+        lines.append(f"# HELP feishu_backup_{name} {help}")
+        lines.append(f"# TYPE feishu_backup_{name} {kind}")
+
+    def histogram(name, label, values):
+        for key, value in values.items():
+            for le, count in value["buckets"].items():
+                lines.append(
+                    f'feishu_backup_{name}_bucket{{{label}="{key}",le="{le}"}} {count}'
+                )
+            lines.append(f'feishu_backup_{name}_sum{{{label}="{key}"}} {value["sum"]}')
+            lines.append(
+                f'feishu_backup_{name}_count{{{label}="{key}"}} {value["count"]}'
+            )
+
+    metric("requests_total", "counter", "HTTP requests by endpoint family and status")
+    for family, value in data["requests"].items():
+        for status, count in value["status"].items():
+            lines.append(
+                f'feishu_backup_requests_total{{family="{family}",status="{status}"}} {count}'
+            )
+    metric("request_seconds", "histogram", "HTTP request latency")
+    histogram(
+        "request_seconds",
+        "family",
+        {family: value["latency"] for family, value in data["requests"].items()},
+    )
+    metric("bytes_total", "counter", "Bytes downloaded")
+    for family, value in data["requests"].items():
+        lines.append(f'feishu_backup_bytes_total{{family="{family}"}} {value["bytes"]}')
+    metric("render_seconds", "histogram", "Markdown render time by document type")
+    histogram("render_seconds", "type", data["render"])
+    metric("documents_total", "counter", "Documents saved by type")
+    for obj_type, count in data["documents"].items():
+        lines.append(f'feishu_backup_documents_total{{type="{obj_type}"}} {count}')
+    metric("documents_per_second", "gauge", "Documents saved per second")
+    lines.append(f'feishu_backup_documents_per_second {data["documents_per_second"]}')
+    metric("queue_depth_max", "gauge", "Max number of queued tasks")
+    for name, value in data["queues"].items():
+        lines.append(f'feishu_backup_queue_depth_max{{queue="{name}"}} {value["max"]}')
+    metric("run_seconds", "gauge", "Duration of the run")
+    lines.append(f'feishu_backup_run_seconds {data["elapsed"]}')
+    return "\n".join(lines) + "\n"
+
+
+# jobs of a batch finish in parallel and write to the same folder
+write_lock = threading.Lock()
+
+
+def write(folder):
+    # metrics.json and metrics.prom, replaced atomically for the textfile collector
+    os.makedirs(folder, exist_ok=True)
+    with write_lock:
+        for name, text in [
+            ("metrics.json", json.dumps(to_json(), indent=1)),
+            ("metrics.prom", to_prometheus()),
+        ]:
+            tmp_path = f"{folder}/{name}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, f"{folder}/{name}")
+
+
+def stats():
+    data = to_json()
+    lines = []
+    for family, value in data["requests"].items():
+        latency = value["latency"]
+        lines.append(
+            f"{family}: {latency['count']} requests, "
+            f"{latency['sum'] / latency['count']:.2f}s avg, {value['bytes']} bytes"
+        )
+    lines.append(
+        f"{sum(data['documents'].values())} documents in {data['elapsed']:.1f}s, "
+        f"{data['documents_per_second']:.2f}/s"
+    )
+    return lines
+
+
+def profiled(fn, file_path):
+    # cProfile fn in the calling thread, threads of worker pools are not
+    # included; the stats are saved to file_path for pstats or snakeviz
+    def wrapper(*args, **kwargs):
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(fn, *args, **kwargs)
+        finally:
+            profiler.dump_stats(file_path)
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+
+    return wrapper
@@ -0,0 +1,344 @@
+import contextlib
+import filecmp
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import threading
+import time
+from images import link_file
+
+# where the backup files go, paths are relative to the backup root
+# and start with "/", e.g. "/folder/doc.md" or "/calendar/event.ics"
+#
+# files whose content did not change are not written again, so they keep
+# their mtime and rsync or snapshot tools don't pick them up
+#
+# dir: one file per document below backup_path (default)
+# sqlite: append-only table of files in backup_path/backup.sqlite
+# tar: append-only tar.zst stream in backup_path/backup.tar.zst
+
+formats = ["dir", "sqlite", "tar"]
+
+chunk_size = 1024 * 1024
+# buffer of the streaming writers from open()
+buffer_size = 1024 * 1024
+
+
+def open_output(format, backup_path):
+    if format == "dir":
+        return DirectoryOutput(backup_path)
+    staging = f"{backup_path}/.staging"
+    if format == "sqlite":
+        return SqliteOutput(f"{backup_path}/backup.sqlite", staging)
+    if format == "tar":
+        return TarOutput(f"{backup_path}/backup.tar.zst", staging)
+    raise ValueError(f"Unknown output format {format}")
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def replace_changed(src, dest) -> bool:
+    # move src to dest unless dest has the same content, then src is removed
+    # returns True if dest was replaced; the caller fsyncs the directory
+    if os.path.exists(dest) and filecmp.cmp(src, dest, shallow=False):
+        os.remove(src)
+        return False
+    fsync_path(src)
+    os.replace(src, dest)
+    return True
+
+
+class Output:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # files written and files skipped because they did not change
+        self.written = 0
+        self.skipped = 0
+
+    def stats(self) -> str:
+        return f"{self.written} files written, {self.skipped} unchanged"
+
+
+class DirectoryOutput(Output):
+    # new content goes to a temporary file in the staging folder first and
+    # is renamed into place, the directories are fsynced once per flush
+    def __init__(self, root) -> None:
+        super().__init__()
+        self.root = root
+        self.staging = f"{root}/.staging"
+        # directories with files renamed into them since the last flush
+        self.dirty = set()
+        os.makedirs(self.staging, exist_ok=True)
+
+    def exists(self, path) -> bool:
+        return os.path.exists(f"{self.root}{path}")
+
+    def write(self, path, text):
+        with self.open(path) as file:
+            file.write(text)
+
+    @contextlib.contextmanager
+    def open(self, path):
+        # stream a large text file, it replaces the old one once complete
+        fd, tmp_path = tempfile.mkstemp(dir=self.staging)
+        try:
+            with open(fd, "w", encoding="utf-8", buffering=buffer_size) as file:
+                yield file
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.commit(path, tmp_path)
+
+    def commit(self, path, src):
+        file_path = f"{self.root}{path}"
+        directory = os.path.dirname(file_path)
+        os.makedirs(directory, exist_ok=True)
+        written = replace_changed(src, file_path)
+        with self.lock:
+            if written:
+                self.written += 1
+                self.dirty.add(directory)
+            else:
+                self.skipped += 1
+
+    def add_file(self, path, src):
+        # used for images from the image store
+        file_path = f"{self.root}{path}"
+        written = not os.path.exists(file_path)
+        if written:
+            link_file(src, file_path)
+        with self.lock:
+            if written:
+                self.written += 1
+                self.dirty.add(os.path.dirname(file_path))
+            else:
+                self.skipped += 1
+
+    def remove(self, path):
+        if os.path.exists(f"{self.root}{path}"):
+            os.remove(f"{self.root}{path}")
+            with self.lock:
+                self.dirty.add(os.path.dirname(f"{self.root}{path}"))
+
+    def render_dir(self, folder):
+        return tempfile.mkdtemp(dir=self.staging)
+
+    def commit_dir(self, folder, render_dir, files):
+        for name in files:
+            self.commit(f"{folder}/{name}", f"{render_dir}/{name}")
+        shutil.rmtree(render_dir)
+
+    def flush(self):
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = set()
+        for directory in dirty:
+            fsync_path(directory)
+
+    def close(self):
+        self.flush()
+
+
+class ArchiveOutput(Output):
+    # common part of the single file outputs
+    # renderers write into a staging folder, the files are moved into the
+    # archive afterwards by the main process
+    def __init__(self, staging) -> None:
+        super().__init__()
+        self.staging = staging
+        os.makedirs(staging, exist_ok=True)
+
+    def write(self, path, text):
+        data = text.encode("utf-8")
+        with tempfile.NamedTemporaryFile(dir=self.staging) as file:
+            file.write(data)
+            file.flush()
+            self.add_file(path, file.name)
+
+    @contextlib.contextmanager
+    def open(self, path):
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", buffering=buffer_size, dir=self.staging
+        ) as file:
+            yield file
+            file.flush()
+            self.add_file(path, file.name)
+
+    def render_dir(self, folder):
+        return tempfile.mkdtemp(dir=self.staging)
+
+    def commit_dir(self, folder, render_dir, files):
+        for name in files:
+            self.add_file(f"{folder}/{name}", f"{render_dir}/{name}")
+        shutil.rmtree(render_dir)
+
+
+def file_hash(src):
+    h = hashlib.sha256()
+    with open(src, "rb") as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class SqliteOutput(ArchiveOutput):
+    # files(path, hash) rows are only appended, the latest row of a path wins
+    # and a NULL hash marks a removed file; contents are stored once per hash
+    def __init__(self, file_path, staging) -> None:
+        super().__init__(staging)
+        self.db = sqlite3.connect(file_path, check_same_thread=False)
+        self.db.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, data BLOB);
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                path TEXT NOT NULL,
+                hash TEXT,
+                mtime REAL
+            );
+            CREATE INDEX IF NOT EXISTS files_path ON files (path, id);
+            """
+        )
+        self.pending = 0
+
+    def latest(self, path):
+        row = self.db.execute(
+            "SELECT hash FROM files WHERE path = ? ORDER BY id DESC LIMIT 1", (path,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def exists(self, path) -> bool:
+        with self.lock:
+            return self.latest(path) is not None
+
+    def add_file(self, path, src):
+        digest = file_hash(src)
+        size = os.path.getsize(src)
+        with self.lock:
+            if self.latest(path) == digest:
+                self.skipped += 1
+                return
+            self.written += 1
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO blobs (hash, data) VALUES (?, zeroblob(?))",
+                (digest, size),
+            )
+            if cursor.rowcount > 0:
+                # stream the content into the new blob
+                with self.db.blobopen("blobs", "data", cursor.lastrowid) as blob:
+                    with open(src, "rb") as file:
+                        while True:
+                            chunk = file.read(chunk_size)
+                            if not chunk:
+                                break
+                            blob.write(chunk)
+            self.append(path, digest)
+
+    def remove(self, path):
+        with self.lock:
+            if self.latest(path) is not None:
+                self.append(path, None)
+
+    def append(self, path, digest):
+        # called with lock held
+        self.db.execute(
+            "INSERT INTO files (path, hash, mtime) VALUES (?, ?, ?)",
+            (path, digest, time.time()),
+        )
+        self.pending += 1
+        if self.pending >= 1000:
+            self.db.commit()
+            self.pending = 0
+
+    def flush(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+# pax header marking a removed file in the tar stream
+deleted_header = "FEISHUBACKUP.deleted"
+
+
+class TarOutput(ArchiveOutput):
+    # every run appends a zstd frame with a tar stream to the archive
+    # read it back with ignore_zeros, later members replace earlier ones
+    # the index next to it maps path -> {"size", "mtime", "hash"} of present files
+    def __init__(self, file_path, staging) -> None:
+        try:
+            import zstandard
+        except ImportError:
+            raise SystemExit("tar output needs the zstandard package")
+
+        super().__init__(staging)
+        self.index_path = f"{file_path}.index.json"
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                self.index = json.load(file)
+
+        self.file = open(file_path, "ab")
+        self.writer = zstandard.ZstdCompressor().stream_writer(self.file)
+        self.tar = tarfile.open(
+            fileobj=self.writer, mode="w|", format=tarfile.PAX_FORMAT
+        )
+
+    def exists(self, path) -> bool:
+        with self.lock:
+            return path in self.index
+
+    def add_file(self, path, src):
+        info = tarfile.TarInfo(path.lstrip("/"))
+        info.size = os.path.getsize(src)
+        info.mtime = time.time()
+        digest = file_hash(src)
+        with self.lock:
+            if self.index.get(path, {}).get("hash") == digest:
+                self.skipped += 1
+                return
+            self.written += 1
+            with open(src, "rb") as file:
+                self.tar.addfile(info, file)
+            self.index[path] = {"size": info.size, "mtime": info.mtime, "hash": digest}
+
+    def remove(self, path):
+        with self.lock:
+            if path not in self.index:
+                return
+            info = tarfile.TarInfo(path.lstrip("/"))
+            info.mtime = time.time()
+            info.pax_headers = {deleted_header: "1"}
+            self.tar.addfile(info)
+            del self.index[path]
+
+    def flush(self):
+        with self.lock:
+            self.writer.flush()
+
+    def close(self):
+        with self.lock:
+            self.tar.close()
+            self.writer.close()
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump(self.index, file, ensure_ascii=False)
+            os.replace(tmp_path, self.index_path)
@@ -0,0 +1,155 @@
+import multiprocessing
+import os
+import threading
+import time
+import contextvars
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from rawstore import read_records
+from render import dump_raw
+import metrics
+
+# rendering stage: markdown is rendered from the raw store in worker
+# processes, separate from the threads doing network requests
+
+
+def mp_context():
+    # the pools start while other threads hold locks, a forked child could
+    # inherit one of them locked, see https://github.com/python/cpython/issues/90622
+    # forkserver is not available on windows
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def render_file(raw_path, folder, file_name, csv=False):
+    # returns the image tokens referenced by the document
+    # and the names of the files written into folder
+    name = os.path.splitext(file_name)[0]
+    files = [file_name]
+
+    csv_open = None
+    if csv:
+
+        def csv_open(sheet):
+            files.append(f'{name} - {sheet["title"]}.csv')
+            return open(f"{folder}/{files[-1]}", "w", newline="")
+
+    with open(f"{folder}/{file_name}", "w") as f:
+        image_tokens = dump_raw(read_records(raw_path), f, csv_open)
+    return image_tokens, files
+
+
+def timed_render_file(*args):
+    # render time without the wait for a free process
+    start = time.monotonic()
+    result = render_file(*args)
+    return result, time.monotonic() - start
+
+
+class RenderStage:
+    def __init__(self, jobs, csv=False, backlog=None) -> None:
+        self.csv = csv
+        # jobs=0 renders in the calling thread
+        if jobs > 0:
+            self.executor = ProcessPoolExecutor(
+                max_workers=jobs, mp_context=mp_context()
+            )
+        else:
+            self.executor = None
+        if backlog is None:
+            backlog = max(jobs, 1) * 2
+        # documents handed over and not finished yet, fetchers block here
+        # when the renderers fall behind
+        self.slots = threading.BoundedSemaphore(backlog)
+        # the step after rendering, e.g. the images of a document, runs
+        # here and not in the result thread of the process pool
+        self.finishers = ThreadPoolExecutor(max_workers=backlog)
+
+    def submit(self, raw_path, folder, file_name, obj_type, then) -> Future:
+        # render in the background and call then(result) in a finisher thread,
+        # in the context of the caller; returns a Future of then
+        done = Future()
+        if self.executor is None:
+            try:
+                result, seconds = timed_render_file(
+                    raw_path, folder, file_name, self.csv
+                )
+                metrics.render(obj_type, seconds)
+                done.set_result(then(result))
+            except BaseException as e:
+                done.set_exception(e)
+            return done
+
+        self.slots.acquire()
+        metrics.queue("render", 1)
+        context = contextvars.copy_context()
+        future = self.executor.submit(
+            timed_render_file, raw_path, folder, file_name, self.csv
+        )
+        future.add_done_callback(
+            lambda f: self.finishers.submit(
+                context.run, self._finish, f, obj_type, then, done
+            )
+        )
+        return done
+
+    def _finish(self, future, obj_type, then, done):
+        try:
+            result, seconds = future.result()
+            metrics.render(obj_type, seconds)
+            done.set_result(then(result))
+        except BaseException as e:
+            done.set_exception(e)
+        finally:
+            metrics.queue("render", -1)
+            self.slots.release()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        self.finishers.shutdown(wait=True)
+
+
+def render_all(manifest, raw_store, images_root, output, jobs=None, csv=False):
+    # render markdown from the raw store without touching the network
+    # documents are rendered in parallel on all cpu cores, jobs=0 renders
+    # in this process
+    tasks = []
+    for token, entry in manifest.entries.items():
+        if not raw_store.exists(token):
+            print(f'Skipping {entry["path"]}: no raw response saved')
+            continue
+        folder, file_name = entry["path"].rsplit("/", 1)
+        tasks.append((raw_store.path(token), folder, file_name))
+
+    print(f"Rendering {len(tasks)} documents")
+    render_dirs = [output.render_dir(folder) for _, folder, _ in tasks]
+    args = [
+        [raw_path for raw_path, _, _ in tasks],
+        render_dirs,
+        [file_name for _, _, file_name in tasks],
+        [csv] * len(tasks),
+    ]
+    executor = None
+    if jobs == 0:
+        results = map(render_file, *args)
+    else:
+        executor = ProcessPoolExecutor(max_workers=jobs, mp_context=mp_context())
+        results = executor.map(render_file, *args, chunksize=16)
+    try:
+        for (_, folder, file_name), render_dir, (image_tokens, files) in zip(
+            tasks, render_dirs, results
+        ):
+            output.commit_dir(folder, render_dir, files)
+            # images are not downloaded, only linked from the image store
+            for token in image_tokens:
+                image_path = f"{images_root}/{token}.png"
+                if os.path.exists(image_path):
+                    output.add_file(f"{folder}/{token}.png", image_path)
+            print(f"Rendered {folder}/{file_name}")
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+    output.close()
+    print(f"Output: {output.stats()}")
+    print("Finished!")
@@ -0,0 +1,80 @@
+import threading
+
+# --plan: what a run would download, from listings and metadata only
+
+# least api calls to download a document of each type
+# doc: content, docx: one page of blocks, sheet: metainfo and one range batch
+# embedded sheets, more pages and images come on top
+download_calls = {"doc": 1, "docx": 1, "sheet": 2}
+
+
+class Plan:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.documents = []
+        # tokens found, a document reached again is not downloaded again
+        self.tokens = set()
+        self.links = 0
+        self.listing_calls = 0
+
+    def count_listing(self):
+        with self.lock:
+            self.listing_calls += 1
+
+    def add(self, path, name, obj_type, token, revision):
+        with self.lock:
+            if token in self.tokens:
+                self.links += 1
+                return
+            self.tokens.add(token)
+            self.documents.append(
+                {
+                    "path": f"{path}/{name}.md",
+                    "obj_type": obj_type,
+                    "token": token,
+                    "revision": revision,
+                }
+            )
+
+    def report(self, manifest, metadata_calls):
+        types = {}
+        new = []
+        changed = []
+        unchanged = 0
+        seen = set()
+        for doc in self.documents:
+            types[doc["obj_type"]] = types.get(doc["obj_type"], 0) + 1
+            seen.add(doc["token"])
+            if manifest.unchanged(doc["token"], doc["revision"], doc["path"]):
+                unchanged += 1
+            elif doc["token"] in manifest.entries:
+                changed.append(doc)
+            else:
+                new.append(doc)
+        removed = [
+            entry["path"]
+            for token, entry in manifest.entries.items()
+            if token not in seen
+        ]
+
+        for doc in new:
+            print(f"New {doc['path']}")
+        for doc in changed:
+            print(f"Changed {doc['path']}")
+        for path in removed:
+            print(f"Removed {path}")
+
+        counts = ", ".join(f"{count} {name}" for name, count in sorted(types.items()))
+        print(f"Documents: {len(self.documents)} ({counts})")
+        if self.links > 0:
+            print(f"Documents found again at other locations: {self.links}")
+        print(
+            f"Since last run: {len(new)} new, {len(changed)} changed, "
+            f"{unchanged} unchanged, {len(removed)} removed"
+        )
+        downloads = new + changed
+        calls = sum(download_calls[doc["obj_type"]] for doc in downloads)
+        print(
+            f"API calls: {self.listing_calls} listing and {metadata_calls} metadata made, "
+            f"at least {calls} to download {len(downloads)} documents"
+        )
@@ -0,0 +1,72 @@
+import gzip
+import io
+import json
+import os
+import tempfile
+from output import replace_changed
+
+# raw api responses of every document, one gzipped json lines file per token
+# the first line is a header with the document type, the following lines are
+# the records the renderer consumes: docx blocks, sheet rows or embedded sheets
+
+
+class RawWriter:
+    def __init__(self, file_path, header) -> None:
+        self.file_path = file_path
+        # a token reached at two locations at once is written twice
+        fd, self.tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(file_path), suffix=".tmp"
+        )
+        self.raw = open(fd, "wb")
+        # no name and time in the gzip header, the same records give the same
+        # file and an unchanged document is not written again
+        self.file = io.TextIOWrapper(
+            gzip.GzipFile(
+                filename="", mode="wb", compresslevel=5, fileobj=self.raw, mtime=0
+            ),
+            encoding="utf-8",
+        )
+        self.write(header)
+
+    def write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False))
+        self.file.write("\n")
+
+    def tee(self, records):
+        # pass records through while saving them
+        for record in records:
+            self.write(record)
+            yield record
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        self.raw.close()
+        if exc_type is None:
+            replace_changed(self.tmp_path, self.file_path)
+        else:
+            os.remove(self.tmp_path)
+
+
+class RawStore:
+    def __init__(self, root) -> None:
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, token):
+        return f"{self.root}/{token}.jsonl.gz"
+
+    def writer(self, token, header) -> RawWriter:
+        return RawWriter(self.path(token), header)
+
+    def exists(self, token) -> bool:
+        return os.path.exists(self.path(token))
+
+
+def read_records(file_path):
+    # header first, then the records
+    with gzip.open(file_path, "rt", encoding="utf-8") as file:
+        for line in file:
+            yield json.loads(line)
@@ -0,0 +1,78 @@
+import threading
+
+# documents reached at several locations in one run: through more than one
+# folder, a shortcut or a wiki node
+# each token is saved once at its canonical location, the other locations
+# get a pointer file; locations are "/folder/name.md" like manifest paths
+
+
+class Registry:
+    def __init__(self, previous) -> None:
+        # token -> canonical location of the last run, from the manifest
+        self.previous = previous
+        self.lock = threading.Lock()
+        # token -> canonical location of this run
+        self.canonical = {}
+        # token -> other locations
+        self.links = {}
+        # token -> backup_file args of locations waiting for the canonical
+        # location of the last run to be reached
+        self.parked = {}
+
+    def claim(self, path, name, obj_type, token, revision):
+        # returns whether the document is saved at this location and the
+        # (location, canonical location) pointers to write
+        location = f"{path}/{name}.md"
+        with self.lock:
+            canonical = self.canonical.get(token)
+            if canonical == location:
+                return False, []
+            if canonical is not None:
+                links = self.links.setdefault(token, [])
+                if location not in links:
+                    links.append(location)
+                return False, [(location, canonical)]
+
+            previous = self.previous.get(token)
+            if previous is not None and previous != location:
+                # keep the location of the last run if it is reached again,
+                # so the saved copy does not move between runs
+                self.parked.setdefault(token, []).append(
+                    (path, name, obj_type, token, revision)
+                )
+                return False, []
+
+            self.canonical[token] = location
+            return True, self.unpark(token, location)
+
+    def unpark(self, token, canonical):
+        # called with lock held
+        links = []
+        for path, name, *_ in self.parked.pop(token, []):
+            location = f"{path}/{name}.md"
+            if location != canonical and location not in links:
+                links.append(location)
+        self.links.setdefault(token, []).extend(links)
+        return [(location, canonical) for location in links]
+
+    def resolve(self):
+        # once everything is listed: documents whose last location was not
+        # reached are saved at the first location they were found at
+        # returns (backup_file args, pointers) of each of them
+        result = []
+        with self.lock:
+            for token in list(self.parked):
+                args = self.parked[token][0]
+                canonical = f"{args[0]}/{args[1]}.md"
+                self.canonical[token] = canonical
+                result.append((args, self.unpark(token, canonical)))
+        return result
+
+    def duplicates(self) -> int:
+        with self.lock:
+            return sum(len(links) for links in self.links.values())
+
+    def all_links(self):
+        # token -> other locations of every document reached in this run
+        with self.lock:
+            return {token: self.links.get(token, []) for token in self.canonical}
@@ -0,0 +1,424 @@
+import csv
+import io
+import json
+from typing import List
+
+# markdown renderers for doc, docx and sheet content
+# renderers write fragments to an output sink (anything with write()),
+# so rendering time and memory grow linearly with the document size
+
+
+def write_markdown_row(out, row, header=False):
+    out.write("|")
+    for col in row:
+        out.write(" ")
+        if isinstance(col, list):
+            # text run
+            for v in col:
+                out.write(v["text"])
+        else:
+            # string/number
+            out.write(str(col))
+        out.write(" |")
+    out.write("\n")
+
+    # separator
+    if header:
+        out.write("|")
+        out.write("-|" * len(row))
+        out.write("\n")
+
+
+def write_markdown_table(out, data: List[List[str]]):
+    for i, row in enumerate(data):
+        write_markdown_row(out, row, header=i == 0)
+
+
+def csv_cell(col):
+    if col is None:
+        return ""
+    if isinstance(col, list):
+        return "".join(map(lambda v: v["text"], col))
+    return col
+
+
+class TableWriter:
+    # streams the rows of one sheet into a markdown table and optionally csv
+    # rows are received in chunks, trailing empty rows of the grid are dropped
+    def __init__(self, out, csv_out=None) -> None:
+        self.out = out
+        self.csv = csv.writer(csv_out) if csv_out is not None else None
+        self.rows = 0
+        self.empty_rows = []
+
+    def write(self, rows):
+        for row in rows:
+            if all(col is None for col in row):
+                self.empty_rows.append(row)
+                continue
+            for empty_row in self.empty_rows:
+                self.write_row(empty_row)
+            self.empty_rows = []
+            self.write_row(row)
+
+    def write_row(self, row):
+        write_markdown_row(self.out, row, header=self.rows == 0)
+        if self.csv is not None:
+            self.csv.writerow(map(csv_cell, row))
+        self.rows += 1
+
+
+def render_markdown_table(data: List[List[str]]) -> str:
+    out = io.StringIO()
+    write_markdown_table(out, data)
+    return out.getvalue()
+
+
+# doc spec
+# https://open.feishu.cn/document/ukTMukTMukTM/uAzM5YjLwMTO24CMzkjN
+
+
+class Dumper:
+    def __init__(self, out, sheet_values=None) -> None:
+        self.out = out
+        # callable (token, sheet_id) -> values of an embedded sheet
+        self.sheet_values = sheet_values
+        self.image_tokens = []
+        self.handlers = {
+            "paragraph": self.print_paragraph,
+            "textRun": self.print_text_run,
+            "gallery": self.print_gallery,
+            "table": self.print_table,
+            "sheet": self.print_sheet,
+        }
+
+    def print_text_run(self, data):
+        text_run = data["textRun"]
+        self.out.write(text_run["text"])
+
+    def print_paragraph(self, data):
+        paragraph = data["paragraph"]
+        if "style" in paragraph:
+            style = paragraph["style"]
+            if "list" in style:
+                l = style["list"]
+                if l["type"] == "checkBox":
+                    self.out.write("- [ ] ")
+                elif l["type"] == "checkedBox":
+                    self.out.write("- [x] ")
+                elif l["type"] == "number":
+                    self.out.write(f'{l["number"]}. ')
+                elif l["type"] == "bullet":
+                    self.out.write("- ")
+            if "headingLevel" in style:
+                # first heading is title
+                heading_level = style["headingLevel"] + 1
+                self.out.write(f'{"#" * heading_level} ')
+        for element in paragraph["elements"]:
+            self.walk(element)
+
+    def print_gallery(self, data):
+        images = data["gallery"]["imageList"]
+        for image in images:
+            token = image["fileToken"]
+            file_name = f"{token}.png"
+            self.image_tokens.append(token)
+            self.out.write(f"![]({file_name})")
+
+    def print_table(self, data):
+        rows = data["table"]["tableRows"]
+        table_data = []
+        # cells are small, render them into their own buffers
+        out = self.out
+        try:
+            for row in rows:
+                cells = row["tableCells"]
+                row_data = []
+                for cell in cells:
+                    body = cell["body"]
+                    blocks = body["blocks"]
+                    self.out = io.StringIO()
+                    if blocks != None:
+                        for block in blocks:
+                            self.walk(block)
+
+                    row_data.append(self.out.getvalue())
+                table_data.append(row_data)
+        finally:
+            self.out = out
+
+        # print table
+        write_markdown_table(self.out, table_data)
+
+    def print_sheet(self, data):
+        sheet_token = data["sheet"]["token"]
+        # first part is token
+        token = sheet_token.split("_")[0]
+        # second part is sheet id
+        sheet_id = sheet_token.split("_")[1]
+        values = self.sheet_values(token, sheet_id)
+        write_markdown_table(self.out, values)
+
+    def walk(self, data):
+        handler = self.handlers.get(data["type"])
+        if handler is None:
+            print(f'Unhandled data type {data["type"]}')
+            print(data)
+            return
+        handler(data)
+
+    def dump(self, content):
+        title = content["title"]["elements"]
+        for element in title:
+            self.out.write("# ")
+            self.walk(element)
+        self.out.write("\n")
+        blocks = content["body"]["blocks"]
+        for block in blocks:
+            self.walk(block)
+            self.out.write("\n")
+
+
+# docx spec
+# https://open.feishu.cn/document/ukTMukTMukTM/uUDN04SN0QjL1QDN/document-docx/docx-structure#2c5327a4
+
+
+class DocxDumper:
+    # blocks arrive as a flat list linked by parent_id and children
+    # they are indexed by block_id once and rendered by a depth first walk
+    # from the root blocks, so the time is linear in the number of blocks
+    def __init__(self, out) -> None:
+        self.out = out
+        self.image_tokens = []
+        # block_id -> block
+        self.blocks = {}
+        # block_id -> child ids, for parents without a children list
+        self.child_ids = {}
+        self.rendered = set()
+        self.handlers = {
+            1: self.print_page,
+            2: lambda block, indent: self.print_line(block, "text", indent, ""),
+            12: lambda block, indent: self.print_item(block, "bullet", indent, "- "),
+            # numbered by print_children, unless the parent is unknown
+            13: lambda block, indent: self.print_item(block, "ordered", indent, "1. "),
+            14: self.print_code,
+            15: lambda block, indent: self.print_line(block, "quote", indent, "> "),
+            17: self.print_todo,
+            19: self.print_quoted,
+            22: lambda block, indent: self.out.write(f"{indent}---\n"),
+            27: self.print_image,
+            31: self.print_table,
+            34: self.print_quoted,
+        }
+        for level in range(1, 10):
+            self.handlers[2 + level] = self.heading(level)
+        # grid, grid column, table cell and view blocks only hold children
+        for block_type in [24, 25, 32, 33]:
+            self.handlers[block_type] = self.print_children
+
+    def heading(self, level):
+        # markdown has six heading levels
+        prefix = "#" * min(level, 6) + " "
+        return lambda block, indent: self.print_line(
+            block, f"heading{level}", indent, prefix
+        )
+
+    def text(self, block, key):
+        result = []
+        for element in block[key]["elements"]:
+            if "text_run" in element:
+                result.append(element["text_run"]["content"])
+            elif "mention_doc" in element:
+                mention = element["mention_doc"]
+                result.append(f'[{mention.get("title", "")}]({mention.get("url", "")})')
+            elif "equation" in element:
+                result.append(f'${element["equation"]["content"].strip()}$')
+        return "".join(result)
+
+    def write_lines(self, text, prefix):
+        for line in text.splitlines():
+            self.out.write(f"{prefix}{line}\n")
+
+    def print_page(self, block, indent):
+        self.out.write(f'# {self.text(block, "page")}\n')
+        self.print_children(block, indent)
+
+    def print_line(self, block, key, indent, prefix):
+        self.out.write(f"{indent}{prefix}{self.text(block, key)}\n")
+        self.print_children(block, indent)
+
+    def print_item(self, block, key, indent, marker):
+        # nested items are indented to the text of their parent item
+        self.out.write(f"{indent}{marker}{self.text(block, key)}\n")
+        self.print_children(block, indent + " " * len(marker))
+
+    def print_todo(self, block, indent):
+        done = block["todo"].get("style", {}).get("done")
+        self.print_item(block, "todo", indent, "- [x] " if done else "- [ ] ")
+
+    def print_code(self, block, indent):
+        self.out.write(f"{indent}```\n")
+        self.write_lines(self.text(block, "code"), indent)
+        self.out.write(f"{indent}```\n")
+
+    def print_image(self, block, indent):
+        image_token = block["image"]["token"]
+        self.image_tokens.append(image_token)
+
+        image_name = f"{image_token}.png"
+        self.out.write(f"{indent}![]({image_name})\n")
+
+    def render_children(self, block):
+        # small containers like quotes and table cells are rendered into
+        # their own buffers
+        out = self.out
+        self.out = io.StringIO()
+        try:
+            self.print_children(block, "")
+            return self.out.getvalue()
+        finally:
+            self.out = out
+
+    def print_quoted(self, block, indent):
+        # callout and quote container
+        self.write_lines(self.render_children(block), f"{indent}> ")
+
+    def print_table(self, block, indent):
+        table = block["table"]
+        columns = table["property"]["column_size"]
+        cells = table.get("cells") or self.children(block)
+        rows = []
+        for start in range(0, len(cells), columns):
+            row = []
+            for cell_id in cells[start : start + columns]:
+                text = ""
+                cell = self.blocks.get(cell_id)
+                if cell is not None and cell_id not in self.rendered:
+                    self.rendered.add(cell_id)
+                    text = self.render_children(cell).strip("\n")
+                row.append(text.replace("|", "\\|").replace("\n", "<br>"))
+            rows.append(row)
+        self.write_lines(render_markdown_table(rows), indent)
+
+    def children(self, block):
+        if "children" in block:
+            return block["children"]
+        return self.child_ids.get(block["block_id"], [])
+
+    def print_children(self, block, indent):
+        number = 0
+        for child_id in self.children(block):
+            child = self.blocks.get(child_id)
+            if child is None:
+                continue
+            if child["block_type"] != 13:
+                number = 0
+                self.walk(child, indent)
+                continue
+
+            # ordered list items are numbered among their siblings, a
+            # sequence in the style starts over from that number
+            sequence = child["ordered"].get("style", {}).get("sequence", "auto")
+            number = int(sequence) if str(sequence).isdigit() else number + 1
+            if child_id not in self.rendered:
+                self.rendered.add(child_id)
+                self.print_item(child, "ordered", indent, f"{number}. ")
+
+    def walk(self, block, indent=""):
+        # every block is rendered once, even if it is linked twice
+        if block["block_id"] in self.rendered:
+            return
+        self.rendered.add(block["block_id"])
+        block_type = block["block_type"]
+        handler = self.handlers.get(block_type)
+        if handler is None:
+            # keep the content of unknown containers
+            print(f"Unhandled block type {block_type}")
+            self.print_children(block, indent)
+            return
+        handler(block, indent)
+
+    def dump(self, blocks):
+        order = []
+        for block in blocks:
+            self.blocks[block["block_id"]] = block
+            order.append(block)
+        for block in order:
+            parent = self.blocks.get(block.get("parent_id"))
+            if parent is not None and "children" not in parent:
+                self.child_ids.setdefault(parent["block_id"], []).append(
+                    block["block_id"]
+                )
+
+        # roots first, then blocks none of their parents link to
+        for block in order:
+            if block.get("parent_id") not in self.blocks:
+                self.walk(block)
+        for block in order:
+            self.walk(block)
+
+
+def embedded_sheets(content):
+    # (token, sheet id) of every sheet embedded in a doc, without duplicates
+    found = []
+    stack = [content]
+    while len(stack) > 0:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if node.get("type") == "sheet" and "sheet" in node:
+                sheet_token = node["sheet"]["token"]
+                # first part is token, second part is sheet id
+                key = (sheet_token.split("_")[0], sheet_token.split("_")[1])
+                if key not in found:
+                    found.append(key)
+            else:
+                stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+    return found
+
+
+def dump_sheet(out, tabs, csv_open=None):
+    # tabs: (sheet, values) chunks in order, several chunks per tab
+    # csv_open: optional callable sheet -> file for the csv copy of a tab
+    current = None
+    table = None
+    csv_file = None
+    try:
+        for sheet, values in tabs:
+            if sheet is not current:
+                # next tab
+                if csv_file is not None:
+                    csv_file.close()
+                    csv_file = None
+                current = sheet
+                out.write(f'# {sheet["title"]}\n')
+                if csv_open is not None:
+                    csv_file = csv_open(sheet)
+                table = TableWriter(out, csv_file)
+            table.write(values)
+    finally:
+        if csv_file is not None:
+            csv_file.close()
+
+
+def dump_raw(records, out, csv_open=None) -> List[str]:
+    # render a document from its raw store records, returns the image tokens
+    header = next(records)
+    if header["type"] == "doc":
+        sheets = {}
+        for record in records:
+            sheets[record["sheet"]] = record["values"]
+        dumper = Dumper(out, sheet_values=lambda token, id: sheets[f"{token}_{id}"])
+        dumper.dump(json.loads(header["content"]))
+        return dumper.image_tokens
+    elif header["type"] == "docx":
+        dumper = DocxDumper(out)
+        dumper.dump(records)
+        return dumper.image_tokens
+    elif header["type"] == "sheet":
+        sheets = header["sheets"]
+        tabs = ((sheets[record["sheet"]], record["values"]) for record in records)
+        dump_sheet(out, tabs, csv_open)
+        return []
+    raise ValueError(f'Unknown raw type {header["type"]}')
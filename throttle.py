@@ -0,0 +1,118 @@
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+# adaptive per-endpoint throttling
+# https://open.feishu.cn/document/server-docs/api-call-guide/frequency-control
+#
+# every endpoint family (drive, docx, sheets, calendar, media, ...) keeps a
+# minimum interval between requests: it doubles when the server reports a
+# rate limit and shrinks again with every successful response
+
+# error codes meaning "too many requests"
+rate_limit_codes = {
+    # gateway frequency limit, used by most apis
+    99991400,
+    # sheets
+    90217,
+}
+
+min_interval = 0.05
+max_interval = 10.0
+# multiplier applied to the interval after every successful response
+ramp_up = 0.9
+
+
+class Throttle:
+    def __init__(self, name) -> None:
+        self.name = name
+        self.lock = threading.Lock()
+        self.interval = 0.0
+        self.next_time = 0.0
+        # statistics
+        self.requests = 0
+        self.limited = 0
+        self.waited = 0.0
+        self.max_interval = 0.0
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def reserve(self):
+        # take the next slot, returns the seconds to wait for it
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+            self.requests += 1
+            delay = start - now
+            self.waited += delay
+        return delay
+
+    def success(self):
+        with self.lock:
+            self.interval *= ramp_up
+            if self.interval < min_interval / 2:
+                self.interval = 0.0
+
+    def rate_limited(self, wait):
+        # slow down and pause the whole family for wait seconds
+        with self.lock:
+            self.limited += 1
+            self.interval = min(max(self.interval * 2, min_interval), max_interval)
+            self.max_interval = max(self.max_interval, self.interval)
+            self.next_time = max(self.next_time, time.monotonic() + wait)
+
+    def stats(self) -> str:
+        return f"{self.name}: {self.requests} requests, {self.limited} rate limited, {self.waited:.1f}s throttled, max interval {self.max_interval:.2f}s"
+
+
+def family(url):
+    # /open-apis/drive/v1/medias/... -> media, /open-apis/docx/... -> docx
+    parts = urlparse(url).path.split("/")
+    if len(parts) > 4 and parts[2] == "drive" and parts[4] == "medias":
+        return "media"
+    if len(parts) > 2:
+        return parts[2]
+    return "other"
+
+
+_throttles = {}
+_throttles_lock = threading.Lock()
+
+
+def throttle(url) -> Throttle:
+    name = family(url)
+    with _throttles_lock:
+        if name not in _throttles:
+            _throttles[name] = Throttle(name)
+        return _throttles[name]
+
+
+def backoff(attempt, wait=None):
+    # jittered exponential backoff, at least as long as the server asked for:
+    # the jitter goes on top of its wait, the window must reset first
+    delay = min(2**attempt, 60) * random.uniform(0.5, 1.5)
+    if wait is not None:
+        delay = max(delay, wait + random.uniform(0, 1))
+    return delay
+
+
+def retry_after(resp):
+    # seconds until the rate limit window resets, from the response headers
+    for header in ["x-ogw-ratelimit-reset", "Retry-After"]:
+        value = resp.headers.get(header)
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    return None
+
+
+def stats():
+    with _throttles_lock:
+        return [t.stats() for _, t in sorted(_throttles.items())]
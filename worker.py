@@ -0,0 +1,114 @@
+import asyncio
+import contextvars
+import threading
+import metrics
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# bounded worker pool shared by the crawlers
+# producers block in submit() when too many tasks are queued
+
+
+class WorkerPool:
+    def __init__(self, jobs=1, backlog=None, name="workers") -> None:
+        self.jobs = jobs
+        # queue name in the run metrics
+        self.name = name
+        # jobs=1 keeps the old sequential behaviour: tasks run inline
+        if jobs > 1:
+            self.executor = ThreadPoolExecutor(max_workers=jobs)
+        else:
+            self.executor = None
+        if backlog is None:
+            backlog = jobs * 4
+        self.slots = threading.BoundedSemaphore(backlog)
+        self.lock = threading.Lock()
+        self.error = None
+        # work handed by the tasks to another stage, see track
+        self.tracked = set()
+
+    def submit(self, fn, *args, **kwargs):
+        self.check()
+        if self.executor is None:
+            fn(*args, **kwargs)
+            return
+
+        self.slots.acquire()
+        metrics.queue(self.name, 1)
+        try:
+            # run in the context of the submitter, e.g. its batch job
+            context = contextvars.copy_context()
+            future = self.executor.submit(context.run, fn, *args, **kwargs)
+        except BaseException:
+            metrics.queue(self.name, -1)
+            self.slots.release()
+            raise
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        metrics.queue(self.name, -1)
+        self.slots.release()
+        self._failed(future.exception())
+
+    def _failed(self, error):
+        if error is not None:
+            with self.lock:
+                if self.error is None:
+                    self.error = error
+
+    def track(self, future):
+        # the rest of a task runs in another stage, e.g. the render stage:
+        # join waits for it and its failure is raised like a worker's
+        with self.lock:
+            self.tracked.add(future)
+        future.add_done_callback(self._untrack)
+
+    def _untrack(self, future):
+        with self.lock:
+            self.tracked.discard(future)
+        self._failed(future.exception())
+
+    def check(self):
+        # re-raise the first failure of a worker in the producer
+        if self.error is not None:
+            raise self.error
+
+    def join(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        # the tasks are done, nothing is tracked any more
+        with self.lock:
+            tracked = list(self.tracked)
+        wait(tracked)
+        self.check()
+
+
+def prefetch(fn, items):
+    # map fn over items, the next result is computed in the background
+    # while the caller handles the current one
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = None
+        for item in items:
+            next_future = executor.submit(context.run, fn, item)
+            if future is not None:
+                yield future.result()
+            future = next_future
+        if future is not None:
+            yield future.result()
+
+
+async def prefetch_async(fn, items):
+    # prefetch for coroutines: fn(item) of the next item runs as a task
+    # while the caller handles the current one
+    pending = []
+    try:
+        for item in items:
+            pending.append(asyncio.create_task(fn(item)))
+            if len(pending) > 1:
+                yield await pending.pop(0)
+        while len(pending) > 0:
+            yield await pending.pop(0)
+    finally:
+        for task in pending:
+            task.cancel()